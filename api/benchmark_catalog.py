@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import uuid
+import tempfile
+import resource
+"""
+Benchmarks for the book catalog and lookup code paths
+on a synthetic book-artifacts tree:
+
+    book_root/user/github.com/repo/commit.tar.gz
+    book_root/user/github.com/repo/commit/_build/jupyter_execute/*.ipynb
+    book_root/user/github.com/repo/commit/_build/html/reports/*.log
+    book_root/user/github.com/repo/commit/book-build.log
+
+Pass --roots to spread the repositories over multiple book
+roots (hash sharding, see storage.py).
+
+Times the catalog queries (uncached), load_all and book_get_by_params
+(through the book cache), book_execution_errored, book_log_collector,
+the catalog rebuild and the /api/books and /api/book endpoints (Flask
+test client), then reports latency percentiles and peak RSS. E.g.,
+from the api directory:
+
+    python benchmark_catalog.py --users 50 --repos 4 --commits 5 --json results.json
+
+Pass --max-p95 to exit with an error when any p95 latency (ms)
+exceeds it, so that regressions are caught before deploy.
+The tree is generated under a temporary directory, nothing
+is written under /DATA. The book cache entries go under a key
+of their own (BOOK_CACHE_KEY), removed at the end, so that the
+synthetic books are never served by the API of the same host.
+Pass --cache-redis to use another Redis server altogether.
+"""
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the book catalog and lookup code paths.")
+    parser.add_argument("--users", type=int, default=20, help="Number of users (owners).")
+    parser.add_argument("--repos", type=int, default=3, help="Number of repositories per user.")
+    parser.add_argument("--commits", type=int, default=3, help="Number of built commits per repository.")
+    parser.add_argument("--notebooks", type=int, default=10, help="Number of executed notebooks per book.")
+    parser.add_argument("--log-kb", type=int, default=64, help="Size of the book build log (KB).")
+    parser.add_argument("--failed", type=float, default=0.2, help="Fraction of the books with execution reports.")
+    parser.add_argument("--roots", type=int, default=1, help="Number of book roots (storage volumes) to shard over, at most 2 (MAX_BOOK_ROOTS, see storage.py).")
+    parser.add_argument("--iterations", type=int, default=50, help="Number of timed calls per benchmark.")
+    parser.add_argument("--root", default=None, help="Directory to generate the tree in (temporary if not given).")
+    parser.add_argument("--cache-redis", default=None, help="Redis URL for the book cache (default BOOK_CACHE_REDIS).")
+    parser.add_argument("--json", default=None, help="Write the results to this JSON file.")
+    parser.add_argument("--max-p95", type=float, default=None, help="Fail if a p95 latency (ms) exceeds this value.")
+    return parser.parse_args()
+
+def generate_tree(args):
+    """
+    Write the synthetic book-artifacts tree(s), returns the
+    list of (user, provider, repo, commit) of the books.
+    """
+    import storage
+    rnd = random.Random(0)
+    log_line = "Executing notebook ... done (some output to make the log realistic)\n"
+    log_content = log_line * max(1, args.log_kb * 1024 // len(log_line))
+    books = []
+    for u in range(args.users):
+        for r in range(args.repos):
+            for c in range(args.commits):
+                user, provider, repo = f"user{u:04d}", "github.com", f"repo{r:03d}"
+                commit = hashlib.sha1(f"{user}/{repo}/{c}".encode()).hexdigest()
+                book_dir = storage.book_dir(user, provider, repo, commit)
+                nb_dir = os.path.join(book_dir, "_build", "jupyter_execute")
+                html_dir = os.path.join(book_dir, "_build", "html")
+                os.makedirs(nb_dir)
+                os.makedirs(html_dir)
+                for n in range(args.notebooks):
+                    with open(os.path.join(nb_dir, f"notebook{n:03d}.ipynb"), "w") as f:
+                        f.write('{"cells": [], "metadata": {}, "nbformat": 4, "nbformat_minor": 5}')
+                    with open(os.path.join(html_dir, f"notebook{n:03d}.html"), "w") as f:
+                        f.write("<html></html>")
+                with open(os.path.join(book_dir, "book-build.log"), "w") as f:
+                    f.write(log_content)
+                if rnd.random() < args.failed:
+                    os.makedirs(os.path.join(html_dir, "reports"))
+                    with open(os.path.join(html_dir, "reports", "notebook000.log"), "w") as f:
+                        f.write(log_content)
+                with open(book_dir + ".tar.gz", "wb") as f:
+                    f.write(b"\0" * 1024)
+                books.append((user, provider, repo, commit))
+    return books
+
+def percentile(values, pct):
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[idx]
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def bench(name, func, iterations, results):
+    """
+    Time iterations calls of func, func receives the
+    iteration number (e.g., to pick a different book).
+    """
+    timings = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        func(i)
+        timings.append((time.perf_counter() - start) * 1000)
+    result = {"name": name,
+              "iterations": iterations,
+              "p50_ms": percentile(timings, 50),
+              "p95_ms": percentile(timings, 95),
+              "p99_ms": percentile(timings, 99),
+              "max_ms": max(timings),
+              "peak_rss_mb": peak_rss_mb()}
+    results.append(result)
+    print(f"{name:<40} p50 {result['p50_ms']:9.2f} ms  p95 {result['p95_ms']:9.2f} ms  p99 {result['p99_ms']:9.2f} ms  peak RSS {result['peak_rss_mb']:8.1f} MB")
+
+def main():
+    args = parse_args()
+    root = args.root or tempfile.mkdtemp(prefix="neurolibre-bench-")
+    # Every root is named book-artifacts, see storage.py.
+    book_roots = [os.path.join(root, f"data{i}", "book-artifacts") for i in range(args.roots)]
+    for book_root in book_roots:
+        os.makedirs(book_root, exist_ok=True)
+    # Must be set before the server modules are imported.
+    os.environ['NEUROLIBRE_DATA'] = root
+    os.environ['BOOK_ROOTS'] = ",".join(book_roots)
+    os.environ['BOOK_CATALOG_DB'] = os.path.join(root, "book_catalog.sqlite")
+    os.environ['BOOK_CACHE_KEY'] = f"neurolibre:benchmark:{uuid.uuid4().hex}"
+    if args.cache_redis:
+        os.environ['BOOK_CACHE_REDIS'] = args.cache_redis
+
+    start = time.time()
+    books = generate_tree(args)
+    print(f"Generated {len(books)} books under {', '.join(book_roots)} in {time.time() - start:.1f} seconds.")
+
+    from flask import Flask
+    import book_catalog
+    import book_cache
+    import common
+    import neurolibre_common_api
+
+    htpasswd = os.path.join(root, "htpasswd")
+    open(htpasswd, "w").close()
+    app = Flask(__name__)
+    app.config['FLASK_HTPASSWD_PATH'] = htpasswd
+    app.register_blueprint(neurolibre_common_api.common_api)
+    client = app.test_client()
+
+    rnd = random.Random(1)
+    pick = lambda i: books[rnd.randrange(len(books))]
+    results = []
+    iterations = args.iterations
+    bench("catalog_rebuild", lambda i: book_catalog.catalog_rebuild(), max(1, iterations // 10), results)
+    # Catalog only, to tell its cost from that of the cache.
+    bench("catalog_query()", lambda i: book_catalog.catalog_query(), iterations, results)
+    bench("catalog_query(commit_hash)", lambda i: book_catalog.catalog_query(commit_hash=pick(i)[3]), iterations, results)
+    bench("catalog_query(commit prefix)", lambda i: book_catalog.catalog_query(commit_hash=pick(i)[3][:7]), iterations, results)
+    bench("catalog_page(limit=50)", lambda i: book_catalog.catalog_page(limit=50), iterations, results)
+    # Through the book cache (mostly hits after the first calls).
+    bench("load_all", lambda i: common.load_all(), iterations, results)
+    bench("book_get_by_params(commit_hash)", lambda i: common.book_get_by_params(commit_hash=pick(i)[3]), iterations, results)
+    bench("book_get_by_params(commit prefix)", lambda i: common.book_get_by_params(commit_hash=pick(i)[3][:7]), iterations, results)
+    bench("book_get_by_params(user, repo)", lambda i: common.book_get_by_params(user_name=pick(i)[0], repo_name="repo000"), iterations, results)
+    # Both take owner, repo, provider, commit_hash
+    def errored(i):
+        user, provider, repo, commit = pick(i)
+        common.book_execution_errored(user, repo, provider, commit)
+    def logs(i):
+        user, provider, repo, commit = pick(i)
+        common.book_log_collector(user, repo, provider, commit)
+    bench("book_execution_errored", errored, iterations, results)
+    bench("book_log_collector", logs, iterations, results)
+    bench("GET /api/books", lambda i: client.get("/api/books"), iterations, results)
+    bench("GET /api/books?limit=50", lambda i: client.get("/api/books?limit=50&exclude=notebook_list"), iterations, results)
+    bench("GET /api/books?format=ndjson", lambda i: client.get("/api/books?format=ndjson").get_data(), iterations, results)
+    bench("GET /api/book?commit_hash=", lambda i: client.get(f"/api/book?commit_hash={pick(i)[3]}"), iterations, results)
+
+    try:
+        for key in book_cache.redis_client.scan_iter(f"{book_cache.BOOK_CACHE_KEY}:*"):
+            book_cache.redis_client.delete(key)
+    except book_cache.redis.RedisError as e:
+        print(f"Book cache entries could not be removed: {str(e)}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"parameters": vars(args), "n_books": len(books), "results": results}, f, indent=2)
+
+    if args.max_p95 is not None:
+        slow = [r['name'] for r in results if r['name'] != "catalog_rebuild" and r['p95_ms'] > args.max_p95]
+        if slow:
+            print(f"p95 latency above {args.max_p95} ms for: {', '.join(slow)}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+import json
+import time
+import logging
+import requests
+"""
+Client of the BinderHub build event stream (server-sent events),
+see https://binderhub.readthedocs.io/en/latest/api.html
+
+    - sse_events parses the stream: multi-line data fields,
+      event and id fields, comments (keepalives) are skipped.
+    - binder_events yields the BinderHub events (decoded JSON) of
+      a build request, reconnecting if the stream is dropped or
+      stalls before the build is ready or has failed. Malformed
+      events are logged, not mistaken for failures.
+    - binder_phase_update records the phase transitions (waiting,
+      fetching, building, pushing, built, launching, ready, failed)
+      with their time in the Celery task meta, binder_phase_durations
+      turns them into the duration of each phase.
+"""
+
+# BinderHub sends keepalives every 30 seconds.
+BINDER_READ_TIMEOUT = 120
+BINDER_RECONNECTS = 3
+BINDER_TERMINAL_PHASES = ["ready", "failed"]
+
+def sse_events(lines):
+    """
+    Server-sent events of a stream given its (decoded) lines, as
+    dicts with the event type, the data and the id (None if not set).
+    """
+    data = []
+    event = None
+    event_id = None
+    for line in lines:
+        if line == "":
+            # A blank line dispatches the event, if any data came.
+            if data:
+                yield {"event": event or "message", "data": "\n".join(data), "id": event_id}
+            data = []
+            event = None
+            continue
+        if line.startswith(":"):
+            # Comment, e.g. keepalive.
+            continue
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if field == "data":
+            data.append(value)
+        elif field == "event":
+            event = value
+        elif field == "id":
+            event_id = value
+    # The stream ended without a blank line after the last event.
+    if data:
+        yield {"event": event or "message", "data": "\n".join(data), "id": event_id}
+
+def binder_events(binderhub_request, response=None, reconnects=BINDER_RECONNECTS):
+    """
+    BinderHub events of a build request (response is the one of
+    a request already made, if any). The stream is reopened up to
+    reconnects times if it ends before a terminal phase, BinderHub
+    attaches the new request to the build in progress.
+
+    A failed event is yielded if the build cannot be followed.
+    """
+    attempt = 0
+    while True:
+        try:
+            if response is None:
+                response = requests.get(binderhub_request, stream=True, timeout=(30, BINDER_READ_TIMEOUT))
+            if not response.ok:
+                yield {"phase": "failed", "message": f"BinderHub request failed: {response.status_code} {response.reason}"}
+                return
+            for sse in sse_events(response.iter_lines(decode_unicode=True)):
+                try:
+                    event = json.loads(sse["data"])
+                except ValueError:
+                    logging.warning(f"Malformed BinderHub event: {sse['data'][:200]}")
+                    continue
+                yield event
+                if event.get('phase') in BINDER_TERMINAL_PHASES:
+                    # MUST close the response when the phase is failed.
+                    response.close()
+                    return
+            reason = "the stream ended"
+        except requests.RequestException as e:
+            reason = str(e)
+        finally:
+            if response is not None:
+                response.close()
+        response = None
+        if attempt >= reconnects:
+            yield {"phase": "failed", "message": f"Lost the BinderHub build event stream ({reason})."}
+            return
+        attempt += 1
+        logging.warning(f"Reconnecting to {binderhub_request} ({reason}), attempt {attempt}.")
+        time.sleep(2 ** attempt)
+
+def binder_phase_update(task, phases, event):
+    """
+    Append the phase of a BinderHub event to phases (a list of
+    {"phase", "time"}) if it changed, and publish them in the meta
+    of the (bound) Celery task. Returns whether the phase changed.
+    """
+    phase = event.get('phase')
+    if not phase or (phases and phases[-1]['phase'] == phase):
+        return False
+    phases.append({"phase": phase, "time": time.time()})
+    task.update_state(state='PROGRESS', meta={"phase": phase, "phases": phases})
+    return True
+
+def binder_phase_durations(phases, end_time=None):
+    """
+    Seconds spent in each phase, until end_time (now if None)
+    for the last one.
+    """
+    durations = {}
+    end_times = [phase['time'] for phase in phases[1:]] + [end_time or time.time()]
+    for phase, end in zip(phases, end_times):
+        durations[phase['phase']] = durations.get(phase['phase'], 0) + round(end - phase['time'], 1)
+    return durations
@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+import redis
+from book_catalog import catalog_state
+"""
+Two tier cache for book catalog queries, shared by the
+gunicorn workers of a server:
+
+    - In-process LRU (front tier) that answers repeated queries
+      without any round-trip, entries live for a few seconds.
+    - Redis (db separate from Celery's) that shares the results
+      between the workers, entries live for BOOK_CACHE_TTL.
+
+Entries are keyed by the catalog generation, which changes whenever
+a book is ingested (built, synced or picked up by the catalog watcher),
+so a result computed from an older catalog is not served for the new
+one, even if it is written after the catalog changed. Entries of the
+older generations expire on their own.
+
+The generation itself is read from the catalog at most every
+GENERATION_TTL seconds (per process), so that a hit does not open
+the catalog. A change shows up at most that long after an ingest.
+"""
+
+BOOK_CACHE_REDIS = os.getenv('BOOK_CACHE_REDIS', 'redis://localhost:6379/2')
+BOOK_CACHE_KEY = os.getenv('BOOK_CACHE_KEY', "neurolibre:book_cache")
+BOOK_CACHE_TTL = 300
+# Entries of the current generation are never stale, this
+# bounds how long those of the older ones are kept around.
+LOCAL_CACHE_TTL = 5
+LOCAL_CACHE_SIZE = 256
+GENERATION_TTL = float(os.getenv('BOOK_CACHE_GENERATION_TTL', 1))
+
+local_cache = OrderedDict()
+local_cache_lock = threading.Lock()
+# Last generation read from the catalog and when.
+generation_cache = {"time": 0, "generation": None}
+redis_client = redis.Redis.from_url(BOOK_CACHE_REDIS, socket_timeout=1)
+
+def local_get(key):
+    with local_cache_lock:
+        entry = local_cache.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry[0] > LOCAL_CACHE_TTL:
+            del local_cache[key]
+            return None
+        local_cache.move_to_end(key)
+        return entry[1]
+
+def local_set(key, value):
+    with local_cache_lock:
+        local_cache[key] = (time.time(), value)
+        local_cache.move_to_end(key)
+        while len(local_cache) > LOCAL_CACHE_SIZE:
+            local_cache.popitem(last=False)
+
+def catalog_generation():
+    """
+    Generation of the catalog, as of GENERATION_TTL seconds ago at most.
+    """
+    now = time.time()
+    if generation_cache["generation"] is None or now - generation_cache["time"] > GENERATION_TTL:
+        generation_cache["generation"] = catalog_state()[0]
+        generation_cache["time"] = now
+    return generation_cache["generation"]
+
+def is_empty(value):
+    """
+    Empty results, or pages (books, cursor) without books.
+    """
+    return not value or (isinstance(value, tuple) and not value[0])
+
+def book_cache_get(key, compute):
+    """
+    Return the cached result of a catalog query identified by key
+    (a string), calling compute() to get (and cache) it on a miss.
+    Empty results are not cached, so that a book that lands on disk
+    shows up as soon as it is ingested. Falls back to compute() if
+    Redis is not reachable.
+    """
+    # Read before computing, a result computed while the catalog
+    # changes is cached under the older generation.
+    generation = catalog_generation()
+    local_key = f"{generation}:{key}"
+    redis_key = f"{BOOK_CACHE_KEY}:{generation}"
+    value = local_get(local_key)
+    if value is not None:
+        return value
+    try:
+        cached = redis_client.hget(redis_key, key)
+    except redis.RedisError as e:
+        logging.warning(f"Book cache is not available: {str(e)}")
+        return compute()
+    if cached is not None:
+        value = json.loads(cached)
+        local_set(local_key, value)
+        return value
+    value = compute()
+    if not is_empty(value):
+        local_set(local_key, value)
+        try:
+            pipe = redis_client.pipeline()
+            pipe.hset(redis_key, key, json.dumps(value))
+            pipe.expire(redis_key, BOOK_CACHE_TTL)
+            pipe.execute()
+        except redis.RedisError as e:
+            logging.warning(f"Book cache is not available: {str(e)}")
+    return value
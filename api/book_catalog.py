@@ -0,0 +1,483 @@
+import os
+import sys
+import glob
+import time
+import json
+import base64
+import sqlite3
+from storage import DATA_ROOT, BOOK_URL, book_glob, book_tarball, book_relpath
+"""
+Persistent catalog of the jupyter books that exist
+on the respective server (preview or preprint).
+
+Books are indexed by user/provider/repo/commit in a SQLite
+database, so that listing and looking up books does not
+require globbing and walking the book-artifacts tree at
+every request. The catalog is filled in when a book is
+ingested (built or synced) and can be reconstructed from
+disk at any time:
+
+    python book_catalog.py rebuild
+
+The catalog is never built inside a request. The API services
+populate it before they start (python book_catalog.py populate),
+which rebuilds it only if no rebuild has ever completed.
+
+See book_catalog_watcher.py for keeping it in sync with
+the file system in between.
+
+Each book has a manifest.json (commit.manifest.json next to
+the commit.tar.gz) written when it is built or synced, the
+catalog reads it instead of walking the book build.
+"""
+
+# GLOBAL VARIABLES
+# Not under the book roots on purpose, nginx serves everything there.
+CATALOG_DB = os.getenv('BOOK_CATALOG_DB', f"{DATA_ROOT}/book_catalog.sqlite")
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    user_name TEXT NOT NULL,
+    provider_name TEXT NOT NULL,
+    repo_name TEXT NOT NULL,
+    commit_hash TEXT NOT NULL,
+    time_added REAL NOT NULL,
+    book TEXT NOT NULL,
+    PRIMARY KEY (user_name, provider_name, repo_name, commit_hash)
+);
+CREATE INDEX IF NOT EXISTS books_commit_hash ON books (commit_hash);
+CREATE INDEX IF NOT EXISTS books_repo_name ON books (repo_name, user_name);
+CREATE INDEX IF NOT EXISTS books_time_added ON books (time_added);
+CREATE TABLE IF NOT EXISTS catalog_state (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    generation INTEGER NOT NULL,
+    last_modified REAL NOT NULL,
+    populated INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO catalog_state VALUES (0, 0, 0, 0);
+"""
+# Recorded as the user_version of the database once the schema is created.
+CATALOG_VERSION = 1
+
+def catalog_connect(db_path=None, readonly=False):
+    """
+    Open a connection to the book catalog. Writers create the
+    database (empty) if it does not exist yet, see catalog_populate.
+
+    Readers (readonly) never write, not even the schema, so that
+    they do not wait for the write lock while a rebuild holds it
+    (WAL lets them read the last committed state meanwhile).
+    """
+    db_path = db_path or CATALOG_DB
+    if readonly:
+        return sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=30)
+    conn = sqlite3.connect(db_path, timeout=30)
+    # Reading the version does not take the write lock, the
+    # schema script (that does) runs once per database.
+    if conn.execute("PRAGMA user_version").fetchone()[0] < CATALOG_VERSION:
+        # Gunicorn workers read while celery workers write.
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(CATALOG_SCHEMA)
+        conn.execute(f"PRAGMA user_version = {CATALOG_VERSION}")
+    return conn
+
+def book_manifest_path(path):
+    """
+    Manifest of a book tarball, written next to it
+    (user/provider/repo/commit.manifest.json).
+    """
+    return path.replace(".tar.gz", ".manifest.json")
+
+def book_write_manifest(path):
+    """
+    Walk the build of a book tarball once and write a compact
+    manifest (notebook list, sizes, file counts and build timestamps)
+    next to it, so that the catalog does not need to walk the tree again.
+    Should be called when a book is built or synced.
+    Returns the manifest content.
+    """
+    curr_dir = path.replace(".tar.gz", "")
+    notebooks = []
+    for (dirpath, dirnames, filenames) in os.walk(curr_dir + "/_build/jupyter_execute"):
+        for input_file in filenames:
+            if input_file.split(".")[-1] == "ipynb":
+                nb_path = os.path.join(dirpath, input_file)
+                notebooks.append({"path": os.path.relpath(nb_path, curr_dir),
+                                  "size": os.path.getsize(nb_path)})
+    notebooks = sorted(notebooks, key=lambda nb: nb['path'])
+    html_files = 0
+    html_size = 0
+    for (dirpath, dirnames, filenames) in os.walk(curr_dir + "/_build/html"):
+        html_files += len(filenames)
+        html_size += sum(os.path.getsize(os.path.join(dirpath, f)) for f in filenames)
+    build_log = curr_dir + "/book-build.log"
+    manifest = {"notebooks": notebooks,
+                "notebook_count": len(notebooks),
+                "html_file_count": html_files,
+                "html_size": html_size,
+                "tarball_size": os.path.getsize(path),
+                "tarball_mtime": os.path.getmtime(path),
+                "build_log_mtime": os.path.getmtime(build_log) if os.path.isfile(build_log) else None,
+                "manifest_time": time.time()}
+    manifest_path = book_manifest_path(path)
+    # Atomic, readers never see a partial manifest.
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return manifest
+
+def book_read_manifest(path):
+    """
+    Manifest of a book tarball, written if it does not exist yet
+    (e.g., books built before manifests were introduced).
+    """
+    manifest_path = book_manifest_path(path)
+    if os.path.isfile(manifest_path):
+        try:
+            with open(manifest_path) as f:
+                return json.load(f)
+        except ValueError:
+            # Corrupted manifest, write a new one.
+            pass
+    return book_write_manifest(path)
+
+def catalog_book_from_path(path, refresh_manifest=False):
+    """
+    Create a book object for a given book tarball path
+    (book_root/user/provider/repo/commit.tar.gz, on any root)
+    from its manifest. The manifest is written again if
+    refresh_manifest (e.g., the book has just been built).
+    """
+    curr_dir = path.replace(".tar.gz", "")
+    path_list = curr_dir.split("/")
+    commit_hash = path_list[-1]
+    repo = path_list[-2]
+    provider = path_list[-3]
+    user = path_list[-4]
+    if refresh_manifest:
+        manifest = book_write_manifest(path)
+    else:
+        manifest = book_read_manifest(path)
+    base_url = BOOK_URL + f"/{user}/{provider}/{repo}/{commit_hash}"
+    nb_list = [f"{base_url}/{nb['path']}" for nb in manifest['notebooks']]
+    book_dict = {"book_url": base_url + "/_build/html/"
+                 , "book_build_logs": base_url + "/book-build.log"
+                 , "download_link": f"{BOOK_URL}/{book_relpath(path)}"
+                 , "notebook_list": nb_list
+                 , "repo_link": f"https://{provider}/{user}/{repo}"
+                 , "user_name": user
+                 , "repo_name": repo
+                 , "provider_name": provider
+                 , "commit_hash": commit_hash
+                 , "time_added": time.ctime(os.path.getctime(path))}
+    return book_dict
+
+def catalog_upsert(conn, path, refresh_manifest=False):
+    """
+    Add (or refresh) the catalog entry of a book tarball.
+    """
+    book = catalog_book_from_path(path, refresh_manifest)
+    conn.execute("INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?, ?, ?)",
+                 (book['user_name'], book['provider_name'], book['repo_name'], book['commit_hash'],
+                  os.path.getctime(path), json.dumps(book)))
+    catalog_touch(conn)
+    return book
+
+def catalog_delete(conn, owner, provider, repo, commit_hash):
+    """
+    Remove the catalog entry of a book, if exists.
+    """
+    cursor = conn.execute("DELETE FROM books WHERE user_name=? AND provider_name=? AND repo_name=? AND commit_hash=?",
+                          (owner, provider, repo, commit_hash))
+    if cursor.rowcount:
+        catalog_touch(conn)
+
+def catalog_touch(conn):
+    """
+    Record that the catalog content has changed. The state
+    (generation, last_modified) is what the API derives its
+    ETag and Last-Modified headers from.
+    """
+    conn.execute("UPDATE catalog_state SET generation = generation + 1, last_modified = ? WHERE id = 0", (time.time(),))
+
+def catalog_state():
+    """
+    Returns the (generation, last_modified) of the catalog.
+    """
+    conn = catalog_connect(readonly=True)
+    try:
+        state = conn.execute("SELECT generation, last_modified FROM catalog_state WHERE id = 0").fetchone()
+    finally:
+        conn.close()
+    return tuple(state)
+
+def catalog_ingest(owner, provider, repo, commit_hash, conn=None):
+    """
+    Register the book built (or synced) for owner/provider/repo
+    at commit_hash, writing its manifest. Removes a stale entry
+    if the book tarball does not exist (e.g., failed build).
+
+    Provider is the full name (e.g., github.com) as used in the
+    book-artifacts directory structure.
+
+    Returns the book object, None if no book exists.
+    """
+    own_conn = conn is None
+    conn = conn or catalog_connect()
+    path = book_tarball(owner, provider, repo, commit_hash)
+    try:
+        with conn:
+            if os.path.isfile(path):
+                book = catalog_upsert(conn, path, refresh_manifest=True)
+            else:
+                catalog_delete(conn, owner, provider, repo, commit_hash)
+                book = None
+    finally:
+        if own_conn:
+            conn.close()
+    return book
+
+def catalog_paths(globpath=None):
+    """
+    Book tarballs on disk, on all the book roots
+    unless a glob pattern is given.
+    """
+    if globpath:
+        return glob.glob(globpath)
+    return book_glob()
+
+def catalog_rebuild(globpath=None, conn=None):
+    """
+    Reconstruct the catalog from the books that exist on disk.
+    Returns the number of books in the catalog.
+    """
+    own_conn = conn is None
+    conn = conn or catalog_connect()
+    try:
+        with conn:
+            conn.execute("DELETE FROM books")
+            catalog_touch(conn)
+            for path in catalog_paths(globpath):
+                catalog_upsert(conn, path)
+            # Only committed along with the books.
+            conn.execute("UPDATE catalog_state SET populated = 1 WHERE id = 0")
+        n_books = conn.execute("SELECT COUNT(*) FROM books").fetchone()[0]
+    finally:
+        if own_conn:
+            conn.close()
+    return n_books
+
+def catalog_populate(conn=None):
+    """
+    Rebuild the catalog if no rebuild has completed yet (e.g.,
+    new deployment, or a rebuild that was interrupted). Returns
+    the number of books, None if it was populated already.
+    """
+    own_conn = conn is None
+    conn = conn or catalog_connect()
+    try:
+        populated = conn.execute("SELECT populated FROM catalog_state WHERE id = 0").fetchone()[0]
+        n_books = None if populated else catalog_rebuild(conn=conn)
+    finally:
+        if own_conn:
+            conn.close()
+    return n_books
+
+def catalog_reconcile(globpath=None, conn=None):
+    """
+    Bring the catalog in line with the disk without rebuilding
+    it: books whose tarball appeared (or changed) are ingested,
+    those whose tarball disappeared are removed. Only the tarballs
+    are listed, existing books are not walked again.
+    Returns the number of added/updated and removed books.
+    """
+    own_conn = conn is None
+    conn = conn or catalog_connect()
+    try:
+        on_disk = {}
+        for path in catalog_paths(globpath):
+            key = tuple(path.replace(".tar.gz", "").split("/")[-4:])
+            on_disk[key] = path
+        in_catalog = {tuple(row[:4]): row[4] for row in
+                      conn.execute("SELECT user_name, provider_name, repo_name, commit_hash, time_added FROM books")}
+        n_updated = 0
+        n_removed = 0
+        with conn:
+            for key, path in on_disk.items():
+                if in_catalog.get(key) != os.path.getctime(path):
+                    catalog_upsert(conn, path)
+                    n_updated += 1
+            for key in in_catalog.keys() - on_disk.keys():
+                catalog_delete(conn, *key)
+                n_removed += 1
+    finally:
+        if own_conn:
+            conn.close()
+    return n_updated, n_removed
+
+# Same as git, shorter prefixes are too likely to be ambiguous.
+MIN_COMMIT_PREFIX = 4
+FULL_COMMIT_LENGTH = 40
+
+class AmbiguousCommitError(ValueError):
+    """
+    Raised when a commit hash prefix matches books
+    built at more than one commit.
+    """
+    def __init__(self, prefix, candidates):
+        self.prefix = prefix
+        self.candidates = candidates
+        super().__init__(f"short commit hash {prefix} is ambiguous, candidates are: {', '.join(candidates)}")
+
+def encode_cursor(sort_key):
+    """
+    Opaque pagination cursor from the sort key of the
+    last book of a page.
+    """
+    return base64.urlsafe_b64encode(json.dumps(sort_key).encode()).decode()
+
+def decode_cursor(cursor):
+    """
+    Returns the sort key encoded in a pagination cursor,
+    raises ValueError if the cursor is not valid.
+    """
+    try:
+        sort_key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError(f"Invalid cursor {cursor}")
+    if not isinstance(sort_key, list) or len(sort_key) != 5:
+        raise ValueError(f"Invalid cursor {cursor}")
+    return sort_key
+
+def catalog_select(user_name=None, commit_hash=None, repo_name=None, provider_name=None,
+                   since=None, until=None, cursor=None, limit=None):
+    """
+    SQL query (and its values) selecting the books that match all
+    the parameters passed, most recent first. See catalog_page.
+    """
+    clauses = []
+    values = []
+    for column, value in (("user_name", user_name), ("repo_name", repo_name), ("provider_name", provider_name)):
+        if value is not None:
+            clauses.append(f"{column}=?")
+            values.append(value)
+    if commit_hash is not None:
+        if len(commit_hash) >= FULL_COMMIT_LENGTH:
+            clauses.append("commit_hash=?")
+            values.append(commit_hash)
+        else:
+            clauses.append(commit_prefix_clause(commit_hash))
+            values.extend(commit_prefix_range(commit_hash))
+    if since is not None:
+        clauses.append("time_added >= ?")
+        values.append(since)
+    if until is not None:
+        clauses.append("time_added <= ?")
+        values.append(until)
+    if cursor is not None:
+        clauses.append("(time_added, user_name, provider_name, repo_name, commit_hash) < (?, ?, ?, ?, ?)")
+        values.extend(decode_cursor(cursor))
+    query = "SELECT time_added, user_name, provider_name, repo_name, commit_hash, book FROM books"
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    query += " ORDER BY time_added DESC, user_name DESC, provider_name DESC, repo_name DESC, commit_hash DESC"
+    if limit is not None:
+        query += " LIMIT ?"
+        values.append(limit)
+    return query, values
+
+def catalog_page(user_name=None, commit_hash=None, repo_name=None, provider_name=None,
+                 since=None, until=None, cursor=None, limit=None):
+    """
+    Return the books that match all the parameters passed (all
+    books if none is passed), most recent first, using the catalog
+    indexes instead of a file system scan.
+
+    since and until are epoch times bounding time_added. When a limit
+    is given, at most limit books are returned, followed by the cursor
+    to pass for the next page (None on the last page).
+    """
+    # One extra row to tell if there is a next page.
+    query, values = catalog_select(user_name, commit_hash, repo_name, provider_name,
+                                   since, until, cursor, limit + 1 if limit is not None else None)
+    conn = catalog_connect(readonly=True)
+    try:
+        rows = conn.execute(query, values).fetchall()
+    finally:
+        conn.close()
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(list(rows[-1][:5]))
+    return [json.loads(row[5]) for row in rows], next_cursor
+
+def catalog_iter(**params):
+    """
+    Generator over the books that match the parameters (see
+    catalog_page), yielding the JSON string of each book as stored
+    in the catalog. Rows are fetched in small batches, so that memory
+    use does not depend on the size of the catalog.
+    """
+    query, values = catalog_select(**params)
+    conn = catalog_connect(readonly=True)
+    try:
+        cursor = conn.execute(query, values)
+        while True:
+            rows = cursor.fetchmany(100)
+            if not rows:
+                break
+            for row in rows:
+                yield row[5]
+    finally:
+        conn.close()
+
+def commit_prefix_clause(prefix):
+    """
+    Range condition that matches the commit hashes starting with
+    a prefix, so that the lookup uses the commit_hash index.
+    """
+    if len(prefix) < MIN_COMMIT_PREFIX:
+        raise ValueError(f"commit hash {prefix} is too short, at least {MIN_COMMIT_PREFIX} characters are needed.")
+    return "commit_hash >= ? AND commit_hash < ?"
+
+def commit_prefix_range(prefix):
+    """
+    Bounds for commit_prefix_clause. Hashes are lower case hex,
+    everything that starts with the prefix sorts before prefix + "g".
+    """
+    prefix = prefix.lower()
+    return [prefix, prefix + "g"]
+
+def catalog_query(user_name=None, commit_hash=None, repo_name=None, provider_name=None):
+    """
+    Return the list of all the books that match all the
+    parameters passed (all books if none is passed).
+
+    commit_hash can be a unique prefix of the hash (at least
+    MIN_COMMIT_PREFIX characters), AmbiguousCommitError is raised
+    if the prefix matches books built at different commits.
+    """
+    books, _ = catalog_page(user_name=user_name, commit_hash=commit_hash,
+                            repo_name=repo_name, provider_name=provider_name)
+    if commit_hash is not None and len(commit_hash) < FULL_COMMIT_LENGTH:
+        candidates = sorted({book['commit_hash'] for book in books})
+        if len(candidates) > 1:
+            raise AmbiguousCommitError(commit_hash, candidates)
+    return books
+
+if __name__ == '__main__':
+    start = time.time()
+    if len(sys.argv) > 1 and sys.argv[1] == "rebuild":
+        n_books = catalog_rebuild()
+        print(f"Book catalog {CATALOG_DB} rebuilt with {n_books} books in {time.time() - start:.1f} seconds.")
+    elif len(sys.argv) > 1 and sys.argv[1] == "populate":
+        n_books = catalog_populate()
+        if n_books is None:
+            print(f"Book catalog {CATALOG_DB} is already populated.")
+        else:
+            print(f"Book catalog {CATALOG_DB} populated with {n_books} books in {time.time() - start:.1f} seconds.")
+    elif len(sys.argv) > 1 and sys.argv[1] == "reconcile":
+        n_updated, n_removed = catalog_reconcile()
+        print(f"Book catalog {CATALOG_DB} reconciled ({n_updated} updated, {n_removed} removed) in {time.time() - start:.1f} seconds.")
+    else:
+        print("Usage: python book_catalog.py rebuild|populate|reconcile")
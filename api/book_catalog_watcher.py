@@ -0,0 +1,130 @@
+import os
+import time
+import logging
+import threading
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+from book_catalog import catalog_connect, catalog_ingest, catalog_reconcile
+from storage import BOOK_ROOTS, book_root_of
+"""
+Daemon that keeps the book catalog in sync with the
+book-artifacts tree(s) using file system (inotify) events,
+so that new books (after a build or rsync) show up without
+a full scan. Only the catalog entry of the affected
+user/provider/repo/commit is updated.
+
+A periodic reconcile pass catches the events that may have
+been missed (e.g., while the daemon was down, or inotify
+queue overflows).
+
+Note that inotify needs one watch per directory, for large
+trees fs.inotify.max_user_watches may need to be increased.
+
+    python book_catalog_watcher.py
+"""
+
+# Builds write thousands of files, collect the affected books
+# and ingest each one of them once per flush interval.
+FLUSH_INTERVAL = 5
+RECONCILE_INTERVAL = int(os.getenv('BOOK_CATALOG_RECONCILE', 3600))
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+def book_key_from_path(path, is_directory=False):
+    """
+    Returns (user, provider, repo, commit) of the book that
+    a path under one of the book roots belongs to, None if
+    the path is not related to a book. E.g.,
+
+    book_root/user/provider/repo/commit.tar.gz
+    book_root/user/provider/repo/commit/_build/...
+    """
+    root = book_root_of(path)
+    if root is None:
+        return None
+    parts = os.path.relpath(path, root).split(os.sep)
+    if len(parts) < 4:
+        return None
+    if len(parts) == 4:
+        if parts[3].endswith(".tar.gz"):
+            return tuple(parts[:3]) + (parts[3].replace(".tar.gz", ""),)
+        if is_directory:
+            # Book directory itself is created/removed.
+            return tuple(parts[:4])
+        # E.g., rsync temporary files.
+        return None
+    if parts[4] == "_build":
+        return tuple(parts[:4])
+    return None
+
+class BookEventHandler(FileSystemEventHandler):
+    """
+    Collects the books affected by file system events
+    to be ingested by the main loop.
+    """
+    def __init__(self):
+        super().__init__()
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def on_any_event(self, event):
+        for path in (event.src_path, getattr(event, 'dest_path', None)):
+            if not path:
+                continue
+            key = book_key_from_path(path, event.is_directory)
+            if key:
+                with self.lock:
+                    self.pending.add(key)
+
+    def pop_pending(self):
+        with self.lock:
+            pending, self.pending = self.pending, set()
+        return pending
+
+    def requeue(self, keys):
+        """
+        Keep books that could not be ingested for the next flush.
+        """
+        with self.lock:
+            self.pending.update(keys)
+
+def run():
+    handler = BookEventHandler()
+    observer = Observer()
+    for root in BOOK_ROOTS:
+        observer.schedule(handler, root, recursive=True)
+    observer.start()
+    logging.info(f"Watching {', '.join(BOOK_ROOTS)} for book changes.")
+    conn = catalog_connect()
+    last_reconcile = 0
+    try:
+        while True:
+            if time.time() - last_reconcile > RECONCILE_INTERVAL:
+                try:
+                    n_updated, n_removed = catalog_reconcile(conn=conn)
+                    logging.info(f"Reconciled the book catalog ({n_updated} updated, {n_removed} removed).")
+                except Exception:
+                    logging.exception("Book catalog could not be reconciled, will try again.")
+                # Either way, not retried at every flush.
+                last_reconcile = time.time()
+            time.sleep(FLUSH_INTERVAL)
+            pending = handler.pop_pending()
+            failed = set()
+            for key in pending:
+                # E.g., files removed while a build tree is being walked.
+                try:
+                    book = catalog_ingest(*key, conn=conn)
+                except Exception:
+                    logging.exception(f"Could not ingest {'/'.join(key)}, will try again.")
+                    failed.add(key)
+                    continue
+                logging.info(f"{'Updated' if book else 'Removed'} {'/'.join(key)} in the book catalog.")
+            handler.requeue(failed)
+    finally:
+        observer.stop()
+        observer.join()
+        conn.close()
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,92 @@
+"""
+Live events of the book builds, published by the Celery tasks
+to a Redis Stream per task id and served to any number of
+watchers as server-sent events (see neurolibre_events_api.py):
+
+    GET /api/book/build/<task_id>/events
+
+Each BinderHub event is an entry of the stream, the build ends
+with an end event (status, book and log URL). Entry ids are sent
+as the event ids, so that a client that reconnects with the
+Last-Event-ID header resumes where it left off.
+
+A response lasts until the end event, the events are served by
+gevent workers (see wsgi_events.py), where a watcher is a greenlet.
+"""
+import os
+import re
+import json
+import logging
+import redis
+
+BUILD_EVENTS_REDIS = os.getenv('BUILD_EVENTS_REDIS', 'redis://localhost:6379/2')
+BUILD_EVENTS_KEY = "neurolibre:build_events"
+# Streams are dropped a day after their last event.
+BUILD_EVENTS_TTL = 86400
+BUILD_EVENTS_MAXLEN = 10000
+# Keepalive interval (seconds) and reconnection delay (ms).
+BUILD_EVENTS_BLOCK = 10
+BUILD_EVENTS_RETRY = 3000
+
+# Must outlive the blocking reads.
+redis_client = redis.Redis.from_url(BUILD_EVENTS_REDIS, socket_timeout=BUILD_EVENTS_BLOCK + 5)
+
+def build_events_key(task_id):
+    return f"{BUILD_EVENTS_KEY}:{task_id}"
+
+def valid_event_id(event_id):
+    """
+    Stream entry ids are of the form milliseconds-sequence.
+    """
+    return re.fullmatch(r"\d+-\d+", event_id or "") is not None
+
+def build_event_publish(task_id, data, event="message"):
+    """
+    Append an event (data is a JSON serializable dict) to the
+    stream of a task, e.g. a BinderHub event or the end event.
+    Builds go on if Redis is not reachable.
+    """
+    key = build_events_key(task_id)
+    try:
+        pipe = redis_client.pipeline()
+        pipe.xadd(key, {"event": event, "data": json.dumps(data)}, maxlen=BUILD_EVENTS_MAXLEN, approximate=True)
+        pipe.expire(key, BUILD_EVENTS_TTL)
+        pipe.execute()
+    except redis.RedisError as e:
+        logging.warning(f"Build event cannot be published: {str(e)}")
+
+def build_events_exist(task_id):
+    return redis_client.exists(build_events_key(task_id)) > 0
+
+def build_events_ended(task_id, last_event_id):
+    """
+    True if last_event_id is the end event of the stream,
+    i.e., the client has already received all the events.
+    """
+    last = redis_client.xrevrange(build_events_key(task_id), count=1)
+    return bool(last) and last[0][0].decode() == last_event_id and last[0][1].get(b"event") == b"end"
+
+def build_events_sse(task_id, last_event_id=None):
+    """
+    Server-sent events of a task after last_event_id (from the
+    start of the build if None), until the end event.
+    """
+    key = build_events_key(task_id)
+    last_id = last_event_id or "0-0"
+    yield f"retry: {BUILD_EVENTS_RETRY}\n\n"
+    while True:
+        try:
+            streams = redis_client.xread({key: last_id}, count=100, block=BUILD_EVENTS_BLOCK * 1000)
+        except redis.RedisError as e:
+            # The client reconnects from the last event it received.
+            logging.warning(f"Build events cannot be read: {str(e)}")
+            return
+        if not streams:
+            yield ": keepalive\n\n"
+            continue
+        for entry_id, fields in streams[0][1]:
+            last_id = entry_id.decode()
+            event = fields.get(b"event", b"message").decode()
+            yield f"id: {last_id}\nevent: {event}\ndata: {fields[b'data'].decode()}\n\n"
+            if event == "end":
+                return
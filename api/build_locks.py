@@ -0,0 +1,143 @@
+"""
+Build locks (one per repository) that prevent recurrent or
+simultaneous builds, and the builds in flight (one per repository
+and commit), shared by the API and the Celery workers of every
+host through Redis.
+
+A lock is taken atomically (SET NX PX) by its owner, e.g. the
+id of the task that runs the build, and expires after the
+rate limit. Only the owner can release it before that (compare
+and delete), unless it is removed through /api/book/unlock.
+"""
+import os
+import json
+import uuid
+import redis
+from build_registry import normalize_repository_url
+
+BUILD_LOCKS_REDIS = os.getenv('BUILD_LOCKS_REDIS', 'redis://localhost:6379/2')
+BUILD_LOCK_KEY = "neurolibre:build_lock"
+
+redis_client = redis.Redis.from_url(BUILD_LOCKS_REDIS, socket_timeout=1)
+
+# Deletes the lock only if it is still held by the owner, e.g.
+# not if it expired and was taken by another build meanwhile.
+RELEASE_SCRIPT = redis_client.register_script("""
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+""")
+
+def build_lock_key(repo_url):
+    return f"{BUILD_LOCK_KEY}:{normalize_repository_url(repo_url)}"
+
+def build_lock_owner():
+    """
+    Owner for the locks that are not taken by a task.
+    """
+    return uuid.uuid4().hex
+
+def build_lock_acquire(repo_url, owner, ttl_minutes):
+    """
+    True if the lock of the repository was free and is now
+    held by owner for ttl_minutes, False otherwise.
+    """
+    return bool(redis_client.set(build_lock_key(repo_url), owner, nx=True, px=int(ttl_minutes * 60000)))
+
+def build_lock_release(repo_url, owner):
+    """
+    Release the lock of the repository if owner holds it,
+    returns whether it did.
+    """
+    try:
+        return RELEASE_SCRIPT(keys=[build_lock_key(repo_url)], args=[owner]) == 1
+    except redis.RedisError:
+        # Expires anyway.
+        return False
+
+def build_lock_remove(repo_url):
+    """
+    Remove the lock of the repository regardless of its owner.
+    """
+    return redis_client.delete(build_lock_key(repo_url)) == 1
+
+def build_lock_status(repo_url):
+    """
+    None if the repository is not locked, the owner and the
+    remaining time (minutes) of the lock otherwise.
+    """
+    pipe = redis_client.pipeline()
+    pipe.get(build_lock_key(repo_url))
+    pipe.pttl(build_lock_key(repo_url))
+    owner, pttl = pipe.execute()
+    if owner is None:
+        return None
+    return {"owner": owner.decode(), "remaining": round(max(pttl, 0) / 60000, 1)}
+
+# Builds in flight: a request for a commit that is being built
+# attaches to the running task (its comment is updated with the
+# outcome) instead of starting another one.
+
+BUILD_INFLIGHT_KEY = "neurolibre:build_inflight"
+BUILD_INFLIGHT_TTL = int(os.getenv('BUILD_INFLIGHT_TTL', 6 * 3600))
+
+# Either claims the build for the task id or attaches the watcher
+# to the task that has claimed it, returns the task id and 1 if claimed.
+JOIN_SCRIPT = redis_client.register_script("""
+local current = redis.call("GET", KEYS[1])
+if not current then
+    redis.call("SET", KEYS[1], ARGV[1], "EX", ARGV[3])
+    return {ARGV[1], 1}
+end
+redis.call("RPUSH", KEYS[2], ARGV[2])
+redis.call("EXPIRE", KEYS[2], ARGV[3])
+return {current, 0}
+""")
+
+# Watchers that attached before the build finished are returned,
+# those that come after start (or get) a build of their own.
+FINISH_SCRIPT = redis_client.register_script("""
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    redis.call("DEL", KEYS[1])
+    local watchers = redis.call("LRANGE", KEYS[2], 0, -1)
+    redis.call("DEL", KEYS[2])
+    return watchers
+end
+return {}
+""")
+
+def build_inflight_keys(repo_url, commit_hash):
+    key = f"{BUILD_INFLIGHT_KEY}:{normalize_repository_url(repo_url)}:{commit_hash}"
+    return [key, f"{key}:watchers"]
+
+def build_inflight_task(repo_url, commit_hash):
+    """
+    Id of the task building the repository at commit_hash, None
+    if there is no such build.
+    """
+    task_id = redis_client.get(build_inflight_keys(repo_url, commit_hash)[0])
+    return task_id.decode() if task_id else None
+
+def build_inflight_join(repo_url, commit_hash, task_id, watcher):
+    """
+    Claim the build of the repository at commit_hash for task_id
+    (to be started by the caller), or attach watcher (a JSON
+    serializable dict, e.g. the issue comment to update) to the
+    task that is already building it. Returns the id of the task
+    building it and whether it was claimed.
+    """
+    current, claimed = JOIN_SCRIPT(keys=build_inflight_keys(repo_url, commit_hash),
+                                   args=[task_id, json.dumps(watcher), BUILD_INFLIGHT_TTL])
+    return current.decode(), claimed == 1
+
+def build_inflight_finish(repo_url, commit_hash, task_id):
+    """
+    Mark the build of task_id as finished, returns the
+    watchers that attached to it.
+    """
+    try:
+        watchers = FINISH_SCRIPT(keys=build_inflight_keys(repo_url, commit_hash), args=[task_id])
+    except redis.RedisError:
+        return []
+    return [json.loads(watcher) for watcher in watchers]
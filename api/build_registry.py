@@ -0,0 +1,202 @@
+import os
+import re
+import sys
+import csv
+import time
+import datetime
+import sqlite3
+from storage import DATA_ROOT, BOOK_ROOT
+"""
+Registry of the builds (docker image and data of a repository
+at a commit) that ran on the preview server, replacing the
+scan of lookup_table.tsv.
+
+Builds are recorded by the preview build tasks and served by
+the preview API (/api/registry/build) with exact lookups by
+repository URL, commit and docker image. The latest successful
+build is returned unless asked otherwise.
+
+Rows of the legacy lookup_table.tsv (still written by the
+book builds) are imported whenever the file changes:
+
+    python build_registry.py import [lookup_table.tsv]
+"""
+
+REGISTRY_DB = os.getenv('BUILD_REGISTRY_DB', f"{DATA_ROOT}/build_registry.sqlite")
+LOOKUP_TABLE = os.getenv('LOOKUP_TABLE', f"{BOOK_ROOT}/lookup_table.tsv")
+# Same fields as the lookup table, so that callers did not change.
+LOOKUP_TABLE_KEYS = ["date","repository_url","docker_image","project_name","data_url","data_doi"]
+
+REGISTRY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    repository_url TEXT NOT NULL,
+    commit_hash TEXT NOT NULL,
+    docker_image TEXT NOT NULL,
+    status TEXT NOT NULL,
+    date TEXT NOT NULL,
+    project_name TEXT,
+    data_url TEXT,
+    data_doi TEXT,
+    time_added REAL NOT NULL,
+    UNIQUE (repository_url, commit_hash, docker_image, status, date)
+);
+CREATE INDEX IF NOT EXISTS builds_repository_url ON builds (repository_url, status, time_added);
+CREATE INDEX IF NOT EXISTS builds_commit_hash ON builds (commit_hash, status, time_added);
+CREATE INDEX IF NOT EXISTS builds_docker_image ON builds (docker_image, status, time_added);
+CREATE TABLE IF NOT EXISTS registry_state (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    lookup_table_mtime REAL NOT NULL
+);
+INSERT OR IGNORE INTO registry_state VALUES (0, 0);
+"""
+
+def normalize_repository_url(repository_url):
+    """
+    So that e.g. http://GitHub.com/user/repo.git/ and
+    https://github.com/user/repo refer to the same builds.
+    """
+    url = repository_url.strip().rstrip("/")
+    if url.endswith(".git"):
+        url = url[:-len(".git")]
+    url = re.sub(r"^http://", "https://", url)
+    return url.lower()
+
+def commit_from_image(docker_image):
+    """
+    BinderHub tags the images with the resolved commit
+    (registry/binder-repo-hash:commit), returns it if so.
+    """
+    tag = docker_image.rsplit(":", 1)[-1] if ":" in docker_image.rsplit("/", 1)[-1] else ""
+    return tag if re.fullmatch(r"[0-9a-f]{40}", tag) else ""
+
+def registry_connect(db_path=None):
+    """
+    Open a connection to the build registry, creating
+    the database if it does not exist yet.
+    """
+    conn = sqlite3.connect(db_path or REGISTRY_DB, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(REGISTRY_SCHEMA)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def registry_record(repository_url, commit_hash, docker_image, status, project_name=None, data_url=None, data_doi=None, conn=None):
+    """
+    Record a build (status is success or failure) of a
+    repository at a commit, e.g. at the end of a book build.
+    """
+    own_conn = conn is None
+    conn = conn or registry_connect()
+    now = time.time()
+    try:
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO builds VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (normalize_repository_url(repository_url), commit_hash or "", docker_image or "", status,
+                          datetime.datetime.fromtimestamp(now).isoformat(timespec="seconds"),
+                          project_name, data_url, data_doi, now))
+    finally:
+        if own_conn:
+            conn.close()
+
+def parse_lookup_date(value):
+    """
+    Dates of the lookup table rows are not consistently formatted,
+    those that cannot be parsed sort before the recorded builds.
+    """
+    try:
+        return datetime.datetime.fromisoformat(value.strip()).timestamp()
+    except ValueError:
+        return 0
+
+def registry_import_tsv(path=None, conn=None):
+    """
+    Import the rows of a lookup_table.tsv as successful builds,
+    rows imported before are skipped. Returns the number of
+    new builds.
+    """
+    own_conn = conn is None
+    conn = conn or registry_connect()
+    path = path or LOOKUP_TABLE
+    n_builds = 0
+    try:
+        with open(path, encoding="utf-8") as f:
+            reader = csv.reader(f, delimiter='\t')
+            # Skip the header row
+            next(reader, None)
+            with conn:
+                for row in reader:
+                    if not row:
+                        continue
+                    # The last two keys are not reliable (may contain commas), see preprint.get_resource_lookup.
+                    lut = dict(zip(LOOKUP_TABLE_KEYS, row[0].split(",")))
+                    if not lut.get("repository_url") or not lut.get("docker_image"):
+                        continue
+                    cursor = conn.execute("INSERT OR IGNORE INTO builds VALUES (?, ?, ?, 'success', ?, ?, ?, ?, ?)",
+                                          (normalize_repository_url(lut["repository_url"]),
+                                           commit_from_image(lut["docker_image"]), lut["docker_image"],
+                                           lut.get("date", ""), lut.get("project_name"), lut.get("data_url"),
+                                           lut.get("data_doi"), parse_lookup_date(lut.get("date", ""))))
+                    n_builds += cursor.rowcount
+                conn.execute("UPDATE registry_state SET lookup_table_mtime = ? WHERE id = 0", (os.path.getmtime(path),))
+    finally:
+        if own_conn:
+            conn.close()
+    return n_builds
+
+def registry_sync(conn):
+    """
+    Import the lookup table if it changed since the last import.
+    """
+    if not os.path.isfile(LOOKUP_TABLE):
+        return 0
+    imported = conn.execute("SELECT lookup_table_mtime FROM registry_state WHERE id = 0").fetchone()[0]
+    if os.path.getmtime(LOOKUP_TABLE) == imported:
+        return 0
+    return registry_import_tsv(LOOKUP_TABLE, conn=conn)
+
+def registry_lookup(repository_url=None, commit_hash=None, docker_image=None, status="success"):
+    """
+    Returns the latest build (a dict with the lookup table fields,
+    commit_hash and status) that matches all the arguments passed,
+    None if there is no such build. Pass status=None for the latest
+    build regardless of its outcome.
+    """
+    if not any([repository_url, commit_hash, docker_image]):
+        return None
+    clauses = []
+    values = []
+    if repository_url:
+        clauses.append("repository_url = ?")
+        values.append(normalize_repository_url(repository_url))
+    if commit_hash:
+        clauses.append("commit_hash = ?")
+        values.append(commit_hash)
+    if docker_image:
+        clauses.append("docker_image = ?")
+        values.append(docker_image)
+    if status:
+        clauses.append("status = ?")
+        values.append(status)
+    if status == "success":
+        # E.g., the image was not reported by BinderHub, the
+        # lookup table row of the same build carries it.
+        clauses.append("docker_image != ''")
+    conn = registry_connect()
+    try:
+        registry_sync(conn)
+        row = conn.execute("SELECT * FROM builds WHERE " + " AND ".join(clauses) +
+                           " ORDER BY time_added DESC, rowid DESC LIMIT 1", values).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    build = dict(row)
+    del build['time_added']
+    return build
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "import":
+        n_builds = registry_import_tsv(sys.argv[2] if len(sys.argv) > 2 else None)
+        print(f"Imported {n_builds} builds to {REGISTRY_DB}.")
+    else:
+        print("Usage: python build_registry.py import [lookup_table.tsv]")
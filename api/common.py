@@ -1,6 +1,9 @@
 import os
-import glob
+import re
+import json
 import time
+import datetime
+from collections import deque
 import git
 from flask import abort
 import yaml
@@ -8,6 +11,11 @@ from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail, Attachment, FileContent, FileName, FileType, Disposition
 import tempfile
 from dotenv import load_dotenv
+from book_cache import book_cache_get
+from storage import book_dir
+from build_locks import build_lock_acquire, build_lock_owner, build_lock_status
+import redis
+from book_catalog import catalog_query, catalog_select, catalog_page, catalog_iter, catalog_state, catalog_ingest, AmbiguousCommitError
 """
 Helper functions for the tasks 
 performed by both servers (preview and preprint).
@@ -15,66 +23,71 @@ performed by both servers (preview and preprint).
 
 
 # GLOBAL VARIABLES
-BOOK_PATHS = "/DATA/book-artifacts/*/*/*/*.tar.gz"
-BOOK_URL = "https://preview.neurolibre.org/book-artifacts"
 DOCKER_REGISTRY = "https://binder-registry.conp.cloud"
+# Lines of the BinderHub build log kept in memory (and posted in comments).
+BINDER_LOG_TAIL = 100
+# Remote HEAD resolutions (repo_url: (time, commit)), see resolve_remote_head.
+HEAD_CACHE_TTL = 60
+head_cache = {}
 
-def load_all(globpath=BOOK_PATHS):
+def load_all():
     """
     Get the list of all the jupyter books that exist in the
-    respective server.
+    respective server. Served from the book catalog, see
+    book_catalog.py to rebuild it from disk.
     """
-    book_collection = []
-    paths = glob.glob(globpath)
-    for path in paths:
-        curr_dir = path.replace(".tar.gz", "")
-        path_list = curr_dir.split("/")
-        commit_hash = path_list[-1]
-        repo = path_list[-2]
-        provider = path_list[-3]
-        user = path_list[-4]
-        nb_list = []
-        for (dirpath, dirnames, filenames) in os.walk(curr_dir + "/_build/jupyter_execute"):
-            for input_file in filenames:
-                if input_file.split(".")[-1] == "ipynb":
-                    nb_list += [os.path.join(dirpath, input_file).replace("/DATA/book-artifacts", BOOK_URL)]
-        nb_list = sorted(nb_list)
-        book_dict = {"book_url": BOOK_URL + f"/{user}/{provider}/{repo}/{commit_hash}/_build/html/"
-                     , "book_build_logs": BOOK_URL + f"/{user}/{provider}/{repo}/{commit_hash}/book-build.log"
-                     , "download_link": BOOK_URL + path.replace("/DATA/book-artifacts", "")
-                     , "notebook_list": nb_list
-                     , "repo_link": f"https://{provider}/{user}/{repo}"
-                     , "user_name": user
-                     , "repo_name": repo
-                     , "provider_name": provider
-                     , "commit_hash": commit_hash
-                     , "time_added": time.ctime(os.path.getctime(path))}
-        book_collection += [book_dict]
-    return book_collection
-
-def book_get_by_params(user_name=None, commit_hash=None, repo_name=None):
+    return book_cache_get("load_all", catalog_query)
+
+def book_ingest(owner, provider, repo, commit_hash):
+    """
+    Register a book that has just been built or synced
+    to the catalog (the cached catalog queries are of
+    the previous generation from then on).
+    Provider is the full name (e.g., github.com).
+    """
+    return catalog_ingest(owner, provider, repo, commit_hash)
+
+def book_get_by_params(user_name=None, commit_hash=None, repo_name=None, provider_name=None):
     """
     Returns a book objet if it exists for one or for the intersection
     of multiple parameters passed as an argument to the function.
-    Typical use case is with commit_hash.
+    Typical use case is with commit_hash, which can also be a unique
+    prefix of the hash (e.g., 7 characters as displayed by git).
+
+    Raises AmbiguousCommitError (a ValueError) if a commit hash prefix
+    matches books built at more than one commit.
+    """
+    if not any(value is not None for value in [user_name, commit_hash, repo_name, provider_name]):
+        return []
+    params = dict(user_name=user_name, commit_hash=commit_hash, repo_name=repo_name, provider_name=provider_name)
+    # Books are ingested by the tasks that build or sync them, those
+    # that land on disk otherwise are picked up by the catalog watcher.
+    return book_cache_get("book:" + json.dumps(params, sort_keys=True), lambda: catalog_query(**params))
+
+def book_page(**params):
+    """
+    Cached catalog_page, see book_catalog.py for the parameters.
+    Returns the books and the cursor of the next page.
+    """
+    books, next_cursor = book_cache_get("page:" + json.dumps(params, sort_keys=True), lambda: catalog_page(**params))
+    return books, next_cursor
+
+def parse_book_date(value):
+    """
+    Convert a date filter passed to the book endpoints (ISO 8601
+    date/datetime or epoch seconds) to epoch seconds.
+    Returns None if no value is passed.
     """
-    books = load_all()
-    # Create an empty list for our results
-    results = []
-    # If we have the hash, return the corresponding book
-    if user_name is not None:
-        for book in books:
-            if book['user_name'] == user_name:
-                results.append(book)
-    elif commit_hash is not None:
-        for book in books:
-            if book['commit_hash'] == commit_hash:
-                results.append(book)
-    elif repo_name is not None:
-        for book in books:
-            if book['repo_name'] == repo_name:
-                results.append(book)
-    return results
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise ValueError(f"cannot parse date {value}, expected ISO 8601 (e.g., 2023-05-01) or epoch seconds.")
 
 def get_owner_repo_provider(repo_url,provider_full_name=False):
     """
@@ -94,16 +107,34 @@ def get_owner_repo_provider(repo_url,provider_full_name=False):
 
     return [owner,repo,provider]
 
-def format_commit_hash(repo_url,commit_hash):
+def resolve_remote_head(repo_url, cached=False):
+    """
+    Commit at the HEAD of a remote repository, asking the remote
+    for HEAD only. If cached, a resolution of the last HEAD_CACHE_TTL
+    seconds is reused, as a run of Zenodo tasks resolves the same
+    repository (e.g., the fork for each archive) repeatedly. Builds
+    must not use it: a push right before a build request would be
+    missed.
+    """
+    now = time.time()
+    hit = head_cache.get(repo_url)
+    if cached and hit and now - hit[0] <= HEAD_CACHE_TTL:
+        return hit[1]
+    commit_hash = "HEAD"
+    for ref in git.cmd.Git().ls_remote(repo_url, "HEAD").split("\n"):
+        if ref.endswith("\tHEAD"):
+            commit_hash = ref.split('\t')[0]
+            head_cache[repo_url] = (now, commit_hash)
+    return commit_hash
+
+def format_commit_hash(repo_url,commit_hash,cached=False):
     """
     Returns the latest commit if HEAD (default endpoint value)
     Returns the hash itself otherwise.
+    See resolve_remote_head for cached.
     """
     if commit_hash == "HEAD":
-        refs = git.cmd.Git().ls_remote(repo_url).split("\n")
-        for ref in refs:
-            if ref.split('\t')[1] == "HEAD":
-                commit_hash = ref.split('\t')[0]
+        commit_hash = resolve_remote_head(repo_url, cached=cached)
     return commit_hash
 
 def get_binder_build_url(binderName, domainName, repo, owner, provider, commit_hash):
@@ -112,56 +143,27 @@ def get_binder_build_url(binderName, domainName, repo, owner, provider, commit_h
     """
     return f"https://{binderName}.{domainName}/build/{provider}/{owner}/{repo}.git/{commit_hash}"
 
-def get_lock_filename(repo_url):
-    """
-    Simple helper function to identify the lock filename.
-    """
-    [owner, repo, provider] = get_owner_repo_provider(repo_url)
-    fname = f"{provider}_{owner}_{repo}.lock"
-    return os.path.join(os.getcwd(),'build_locks',fname)
-
-def check_lock_status(lock_filename,build_rate_limit):
-    """
-    If lock has expired, remove it (unlocked)
-    If not expired, return the remaining time in seconds.
-    If never existed, inform (not_locked)
-    Non-numeric returns are for semantics only. Downstream 
-    flow is determined based on numeric or not. 
-    """
-    if os.path.exists(lock_filename):
-    # If lock exists, check its age first.
-            lock_age_in_sec = time.time() - os.path.getmtime(lock_filename)
-            # If the lock file older than the rate limit, remove.
-            if lock_age_in_sec > build_rate_limit*60:
-                os.remove(lock_filename)
-                return "unlocked"
-            else: 
-                # Return remaining time in seconds
-                return round(build_rate_limit - lock_age_in_sec/60,1)
-    else:
-        return "not_locked"
-    
-def run_binder_build_preflight_checks(repo_url,commit_hash,build_rate_limit, binderName, domainName):
+def run_binder_build_preflight_checks(repo_url,commit_hash,build_rate_limit, binderName, domainName, lock_owner=None):
     """
         Two arguments repo_url and commit_hash are passed with payload
         by the client. The last tree arguments are from configurations.
+        The build lock of the repository is taken by lock_owner (e.g.,
+        the task id) for build_rate_limit minutes, see build_locks.py.
     """
     # Parse url to process
     [owner, repo, provider] = get_owner_repo_provider(repo_url)
 
-    # Get lock filename
-    lock_filename = get_lock_filename(repo_url)
-
-    # First check on build lock conditions.
-    lock_status = check_lock_status(lock_filename,build_rate_limit)
+    # Atomic, so that simultaneous requests cannot both take the lock.
+    try:
+        locked = build_lock_acquire(repo_url, lock_owner or build_lock_owner(), build_rate_limit)
+        lock_status = None if locked else build_lock_status(repo_url)
+    except redis.RedisError as e:
+        abort(503, f"Build locks are not available: {str(e)}")
 
-    if isinstance(lock_status, (int, float)):
+    if not locked:
     # If lock is not expired, deny request and inform the client.
-        abort(409, f"Looks like a build is already in progress for {owner}/{repo}. Will be unlocked in {lock_status} minutes. Please try again later or request unlock (reviewers/editors only).")
-    else:
-        # Create a fresh lock and proceed to build.
-        with open(lock_filename, "w") as f:
-            f.write("")
+        remaining = lock_status['remaining'] if lock_status else 0
+        abort(409, f"Looks like a build is already in progress for {owner}/{repo}. Will be unlocked in {remaining} minutes. Please try again later or request unlock (reviewers/editors only).")
 
     # Get the latest commit hash if HEAD, pass otherwise.
     commit_hash = format_commit_hash(repo_url,commit_hash)
@@ -171,8 +173,40 @@ def run_binder_build_preflight_checks(repo_url,commit_hash,build_rate_limit, bin
 
     return binderhub_request
 
+def binder_log_spool(events, log_path, tail_lines=BINDER_LOG_TAIL, on_event=None):
+    """
+    Write the messages of BinderHub build events (see binder_sse.py)
+    to log_path as they arrive, so that the memory use does not grow
+    with the log (builds may run for hours).
+
+    Every event is passed to on_event if given (e.g., to publish it).
+
+    Returns a dict with the last tail_lines of the log (tail), whether
+    the build failed (failed) and the docker image if reported (docker_image).
+    """
+    tail = deque(maxlen=tail_lines)
+    result = {"failed": False, "docker_image": None}
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    with open(log_path, "w") as log:
+        for event in events:
+            if on_event:
+                on_event(event)
+            if event.get('image'):
+                # Sent along with the ready phase.
+                result['docker_image'] = event['image']
+            message = event.get('message')
+            if message:
+                log.write(message)
+                # Readable (served) while the build is running.
+                log.flush()
+                tail.extend(message.splitlines())
+            if event.get('phase') == 'failed':
+                result['failed'] = True
+    result['tail'] = "\n".join(tail)
+    return result
+
 def book_execution_errored(owner,repo,provider,commit_hash):
-    root_dir = f"/DATA/book-artifacts/{owner}/{provider}/{repo}/{commit_hash}"
+    root_dir = book_dir(owner, provider, repo, commit_hash)
     reports_path = f"{root_dir}/_build/html/reports"
     file_list = None
     if os.path.exists(reports_path) and os.path.isdir(reports_path):
@@ -190,7 +224,7 @@ def book_log_collector(owner,repo,provider,commit_hash):
     while executing the respective notebook ot myST.
     """
     logs = []
-    root_dir = f"/DATA/book-artifacts/{owner}/{provider}/{repo}/{commit_hash}"
+    root_dir = book_dir(owner, provider, repo, commit_hash)
     main_log_file = f"{root_dir}/book-build.log"
     if os.path.isfile(main_log_file):
         with open(main_log_file) as f:
@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import redis
+"""
+Book keeping of the GitHub API quota (5000 requests per hour
+and token), shared by the processes of a server through Redis:
+
+    - The remaining quota of each token, as reported by the
+      X-RateLimit-* headers of the latest response.
+    - The number of requests spent per task type (Celery task
+      name, api for the endpoints), those answered with 304 Not
+      Modified (not counted against the quota) and the updates
+      deferred because the quota ran low.
+
+When the remaining quota is below GH_LOW_BUDGET, low priority
+calls (progress comments) are deferred until the quota resets,
+so that critical ones (forks, configuration commits, final
+status comments) can still go through.
+"""
+
+GH_BUDGET_REDIS = os.getenv('GH_BUDGET_REDIS', 'redis://localhost:6379/2')
+GH_BUDGET_KEY = "neurolibre:github_budget"
+GH_SPEND_KEY = "neurolibre:github_spend"
+GH_LOW_BUDGET = int(os.getenv('GH_LOW_BUDGET', 500))
+
+redis_client = redis.Redis.from_url(GH_BUDGET_REDIS, socket_timeout=1)
+
+def gh_token_label(token):
+    """
+    Tokens are not stored, only a short fingerprint.
+    """
+    return hashlib.sha256((token or "").encode()).hexdigest()[:8]
+
+def gh_task_type():
+    """
+    Name of the Celery task being executed, api otherwise.
+    """
+    try:
+        from celery import current_task
+        if current_task and current_task.name:
+            return current_task.name.split(".")[-1]
+    except ImportError:
+        pass
+    return "api"
+
+def gh_spend(github_client, token_label, kind="calls", count=1):
+    """
+    Count requests of the current task type (kind is calls,
+    not_modified or deferred) and record the remaining quota of
+    the token it was made with.
+    """
+    try:
+        remaining, limit = github_client.rate_limiting
+        reset = github_client.rate_limiting_resettime
+    except Exception:
+        remaining = None
+    try:
+        pipe = redis_client.pipeline()
+        pipe.hincrby(GH_SPEND_KEY, f"{gh_task_type()}:{kind}", count)
+        if remaining is not None and remaining >= 0:
+            pipe.hset(GH_BUDGET_KEY, token_label, json.dumps({"remaining": remaining,
+                                                              "limit": limit,
+                                                              "reset": reset,
+                                                              "time": time.time()}))
+        pipe.execute()
+    except redis.RedisError as e:
+        logging.warning(f"GitHub budget cannot be recorded: {str(e)}")
+
+def gh_budget(token_label):
+    """
+    Latest known quota of a token (remaining, limit, reset),
+    None if unknown or already reset.
+    """
+    try:
+        budget = redis_client.hget(GH_BUDGET_KEY, token_label)
+    except redis.RedisError:
+        return None
+    if budget is None:
+        return None
+    budget = json.loads(budget)
+    if budget['reset'] and time.time() > budget['reset']:
+        return None
+    return budget
+
+def gh_budget_low(token_label):
+    """
+    True if low priority calls should be deferred.
+    """
+    budget = gh_budget(token_label)
+    return budget is not None and budget['remaining'] < GH_LOW_BUDGET
+
+def gh_budget_report():
+    """
+    Quota per token and requests per task type, e.g.
+
+    {"budget": {"1a2b3c4d": {"remaining": 4870, ...}},
+     "spend": {"rsync_book_task": {"calls": 12, "not_modified": 4}}}
+    """
+    budget = {label.decode(): json.loads(value) for label, value in redis_client.hgetall(GH_BUDGET_KEY).items()}
+    spend = {}
+    for field, count in redis_client.hgetall(GH_SPEND_KEY).items():
+        task_type, kind = field.decode().rsplit(":", 1)
+        spend.setdefault(task_type, {})[kind] = int(count)
+    return {"budget": budget, "spend": spend, "low_budget": GH_LOW_BUDGET}
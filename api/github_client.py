@@ -3,16 +3,138 @@ import re
 import pytz
 import datetime
 import json
+import time
 import yaml
+import atexit
+import logging
+import threading
+from github import Github, GithubException, InputGitTreeElement, UnknownObjectException
+from github_budget import gh_token_label, gh_spend, gh_budget_low
 
 # Name of the GitHub organization where repositories 
 # will be forked into for production. Editorial bot 
 # must be authorized for this organization.
 GH_ORGANIZATION = "roboneurolibre"
 
+# Clients (and their pooled HTTP sessions) are created once per
+# process and token, repository/issue/comment objects are reused
+# for GH_CACHE_TTL seconds instead of being fetched at every call.
+# Past that, they are revalidated with conditional requests (ETag),
+# 304 Not Modified responses do not count against the rate limit.
+GH_POOL_SIZE = int(os.getenv('GH_POOL_SIZE', 10))
+GH_CACHE_TTL = int(os.getenv('GH_CACHE_TTL', 60))
+GH_CACHE_SIZE = 512
+
+gh_clients = {}
+gh_client_labels = {}
+gh_cache = {}
+gh_lock = threading.Lock()
+
+# Progress updates of a comment are coalesced, only the latest one is
+# written and at most once per GH_COMMENT_INTERVAL seconds (bursts of
+# edits trigger the secondary rate limits of GitHub).
+GH_COMMENT_INTERVAL = float(os.getenv('GH_COMMENT_INTERVAL', 10))
+# Phases that are written right away, replacing pending progress updates.
+GH_FINAL_PHASES = ["success", "failure", "exists"]
+
+gh_comment_updates = {}
+gh_comment_last_write = {}
+gh_comment_write_locks = {}
+gh_comment_deferred = set()
+gh_comment_lock = threading.Lock()
+gh_comment_worker = None
+
 def isNotBlank(myString):
     return bool(myString and myString.strip())
 
+def gh_get_client(token=None):
+    """
+    Authenticated GitHub client of this process for a token
+    (GH_BOT by default). Celery workers and gunicorn workers fork,
+    so that clients are not shared between processes.
+    """
+    token = token or os.getenv('GH_BOT')
+    key = (os.getpid(), token)
+    with gh_lock:
+        client = gh_clients.get(key)
+        if client is None:
+            client = Github(token, pool_size=GH_POOL_SIZE)
+            gh_clients[key] = client
+            gh_client_labels[id(client)] = gh_token_label(token)
+    return client
+
+def gh_track(github_client, kind="calls", count=1):
+    """
+    Record the requests made with a client (see github_budget.py).
+    """
+    gh_spend(github_client, gh_client_labels.get(id(github_client), "unknown"), kind, count)
+
+def gh_cached(github_client, key, fetch, revalidate=False):
+    """
+    Return the object cached for key if it is not older
+    than GH_CACHE_TTL, call fetch() to get (and cache) it otherwise.
+    Objects that are older (or all if revalidate, e.g. before a write)
+    are refreshed with a conditional request instead of a new fetch.
+    """
+    now = time.time()
+    with gh_lock:
+        entry = gh_cache.get(key)
+    if entry and now - entry[0] <= GH_CACHE_TTL and not revalidate:
+        return entry[1]
+    if entry and hasattr(entry[1], "update"):
+        value = entry[1]
+        changed = value.update()
+        gh_track(github_client, "calls" if changed else "not_modified")
+    else:
+        value = fetch()
+        gh_track(github_client)
+    with gh_lock:
+        if len(gh_cache) >= GH_CACHE_SIZE:
+            # Drop the expired ones first, everything if none.
+            for old_key in [k for k, v in gh_cache.items() if now - v[0] > GH_CACHE_TTL] or list(gh_cache):
+                del gh_cache[old_key]
+        gh_cache[key] = (now, value)
+    return value
+
+def gh_cache_drop(*key):
+    """
+    Remove an object from the cache (e.g., after it changed).
+    """
+    with gh_lock:
+        gh_cache.pop(tuple(key), None)
+
+def gh_get_repo(github_client,repo):
+    """
+    Repository object (repo is a URL or in owner/repository_name format).
+    """
+    name = gh_filter(repo)
+    return gh_cached(github_client, (id(github_client), "repo", name), lambda: github_client.get_repo(name))
+
+def gh_get_issue(github_client,issue_repo,issue_id,revalidate=False):
+    """
+    Issue object of an issue repository. See gh_cached for revalidate.
+    """
+    name = gh_filter(issue_repo)
+    return gh_cached(github_client, (id(github_client), "issue", name, int(issue_id)),
+                     lambda: gh_get_repo(github_client,name).get_issue(number=int(issue_id)),
+                     revalidate=revalidate)
+
+def gh_get_comment(github_client,issue_repo,issue_id,comment_id):
+    """
+    Comment object of an issue.
+    """
+    name = gh_filter(issue_repo)
+    return gh_cached(github_client, (id(github_client), "comment", name, int(issue_id), int(comment_id)),
+                     lambda: gh_get_issue(github_client,name,issue_id).get_comment(int(comment_id)))
+
+def gh_get_contents(github_client,repo,file_path,revalidate=False):
+    """
+    ContentFile object of a file in a repository.
+    """
+    name = gh_filter(repo)
+    return gh_cached(github_client, (id(github_client), "contents", name, file_path),
+                     lambda: gh_get_repo(github_client,name).get_contents(file_path), revalidate)
+
 def gh_response_template(task_name,task_id,message="",collapse=True):
     """
     Please see the docstring of the gh_template_response.
@@ -70,19 +192,100 @@ def gh_create_comment(github_client,issue_repo,issue_id,comment_body):
     """
     To create a new comment under an existing GitHub issue.
     """
-    repo = github_client.get_repo(gh_filter(issue_repo))
-    issue = repo.get_issue(number=issue_id)
+    issue = gh_get_issue(github_client,issue_repo,issue_id)
     commit_comment = issue.create_comment(comment_body)
+    gh_track(github_client)
     return commit_comment.id
 
 def gh_update_comment(github_client, issue_repo,issue_id,comment_id,comment_body):
     """
     Update an existing GitHub issue comment. 
     """
-    repo = github_client.get_repo(gh_filter(issue_repo))
-    issue = repo.get_issue(issue_id)
-    comment = issue.get_comment(comment_id)
+    comment = gh_get_comment(github_client,issue_repo,issue_id,comment_id)
     comment.edit(comment_body)
+    gh_track(github_client)
+
+def gh_comment_write_lock(key):
+    with gh_comment_lock:
+        return gh_comment_write_locks.setdefault(key, threading.Lock())
+
+def gh_comment_write(key):
+    """
+    Write the pending update of a comment, if any. The write lock
+    makes sure that a progress update that is being written cannot
+    land after (and overwrite) a final one.
+    """
+    with gh_comment_write_lock(key):
+        with gh_comment_lock:
+            entry = gh_comment_updates.pop(key, None)
+        if entry is None:
+            return
+        github_client, comment_body = entry
+        gh_comment_deferred.discard(key)
+        try:
+            gh_update_comment(github_client, *key, comment_body)
+        except Exception as e:
+            logging.warning(f"Could not update comment {key[2]} of {key[0]}#{key[1]}: {str(e)}")
+        with gh_comment_lock:
+            gh_comment_last_write[key] = time.time()
+
+def gh_comment_loop():
+    """
+    Background thread that writes the pending comment
+    updates once their minimum interval has passed.
+    """
+    while True:
+        time.sleep(min(1, GH_COMMENT_INTERVAL))
+        now = time.time()
+        with gh_comment_lock:
+            due = [(key, entry[0]) for key, entry in gh_comment_updates.items()
+                   if now - gh_comment_last_write.get(key, 0) >= GH_COMMENT_INTERVAL]
+        for key, github_client in due:
+            # Progress updates wait for the quota to reset when it runs low,
+            # the final update replaces them anyway.
+            if gh_budget_low(gh_client_labels.get(id(github_client), "unknown")):
+                if key not in gh_comment_deferred:
+                    gh_comment_deferred.add(key)
+                    gh_track(github_client, "deferred")
+                continue
+            gh_comment_write(key)
+
+def gh_flush_comment_updates():
+    """
+    Write all the pending comment updates (e.g., at exit).
+    """
+    with gh_comment_lock:
+        keys = list(gh_comment_updates)
+    for key in keys:
+        gh_comment_write(key)
+
+atexit.register(gh_flush_comment_updates)
+
+def gh_enqueue_comment_update(github_client,issue_repo,issue_id,comment_id,comment_body):
+    """
+    Update an existing GitHub issue comment without blocking on the
+    GitHub API. Updates of the same comment are coalesced, only the
+    latest one is written, at most once per GH_COMMENT_INTERVAL.
+    """
+    global gh_comment_worker
+    key = (gh_filter(issue_repo), int(issue_id), int(comment_id))
+    with gh_comment_lock:
+        gh_comment_updates[key] = (github_client, comment_body)
+        # Started in the process that uses it (workers fork).
+        if gh_comment_worker is None or not gh_comment_worker.is_alive():
+            gh_comment_worker = threading.Thread(target=gh_comment_loop, daemon=True)
+            gh_comment_worker.start()
+
+def gh_final_comment_update(github_client,issue_repo,issue_id,comment_id,comment_body):
+    """
+    Update an existing GitHub issue comment right away, dropping the
+    progress updates that are pending for it. To be used for the
+    final state of a task (success or failure).
+    """
+    key = (gh_filter(issue_repo), int(issue_id), int(comment_id))
+    with gh_comment_lock:
+        gh_comment_updates[key] = (github_client, comment_body)
+    gh_comment_write(key)
 
 def gh_template_respond(github_client,phase,task_name,repo,issue_id,task_id="",comment_id="", message="",collapsable=True):
     """
@@ -113,6 +316,11 @@ def gh_template_respond(github_client,phase,task_name,repo,issue_id,task_id="",c
         - failure (icon: green circle)
         Use this phase when the task execution is failed.
 
+        Updates of the started phase are coalesced and written in the
+        background (see gh_enqueue_comment_update), those of the success,
+        failure and exists phases are written right away and replace the
+        pending ones.
+
     task_name
         This will be displayed as the title of the comment assoicated with 
         the task.
@@ -136,6 +344,12 @@ def gh_template_respond(github_client,phase,task_name,repo,issue_id,task_id="",c
     if phase == "pending":
         # This one adds a new comment, returns comment_id
         return gh_create_comment(github_client,repo,issue_id,template['pending'])
+    elif phase == "started":
+        # Progress update, returns None without waiting for GitHub
+        return gh_enqueue_comment_update(github_client,repo,issue_id,comment_id,template[phase])
+    elif phase in GH_FINAL_PHASES:
+        # Final state, returns None once written
+        return gh_final_comment_update(github_client,repo,issue_id,comment_id,template[phase])
     else:
         # This one updates comment, returns None
         return gh_update_comment(github_client,repo,issue_id,comment_id,template[phase])
@@ -146,9 +360,8 @@ def gh_get_project_name(github_client,target_repo):
     file that is required to be located under the binder 
     folder as required by neurolibre.
     """
-    repo = github_client.get_repo(gh_filter(target_repo))
     # This is a requirement
-    contents = repo.get_contents("binder/data_requirement.json")
+    contents = gh_get_contents(github_client,target_repo,"binder/data_requirement.json")
     data = json.loads(contents.decoded_content)
     return data['projectName']
 
@@ -158,19 +371,41 @@ def gh_fork_repository(github_client,source_repo):
     where the final version of preprint repositories
     will be forked into.
     """
-    repo_to_fork = github_client.get_repo(gh_filter(source_repo))
-    target_org = github_client.get_organization(GH_ORGANIZATION)
+    repo_to_fork = gh_get_repo(github_client,source_repo)
+    target_org = gh_cached(github_client, (id(github_client), "org", GH_ORGANIZATION),
+                           lambda: github_client.get_organization(GH_ORGANIZATION))
     forked_repo = target_org.create_fork(repo_to_fork)
+    gh_track(github_client)
     return forked_repo
 
+def gh_fork_ready(github_client,source_repo):
+    """
+    True if the fork of a repository in GH_ORGANIZATION exists and its
+    git data is available (GitHub creates forks asynchronously). Costs
+    a single request: the default branch of the fork. Errors (e.g.,
+    404 or 409 while the fork is being created) count as not ready.
+    """
+    # Fork has the default branch of the source (cached).
+    branch = gh_get_repo(github_client,source_repo).default_branch
+    fork = github_client.get_repo(gh_forkify_name(source_repo), lazy=True)
+    try:
+        fork.get_branch(branch)
+        ready = True
+    except UnknownObjectException:
+        ready = False
+    except GithubException as e:
+        logging.info(f"Fork of {source_repo} is not ready yet ({e.status}).")
+        ready = False
+    gh_track(github_client)
+    return ready
+
 def gh_get_file_content(github_client,repo,file_path):
     """
     Generic helper function to read (raw) file content from
     a github repository.
     """
-    repo = github_client.get_repo(gh_filter(repo))
     try:
-        file_content = repo.get_contents(file_path).decoded_content.decode()
+        file_content = gh_get_contents(github_client,repo,file_path).decoded_content.decode()
     except Exception as e:
         print(f"Error retrieving file content: {str(e)}")
         return ""
@@ -181,16 +416,43 @@ def gh_update_file_content(github_client,repo,file_path,new_content,commit_messa
     Generic helper function to update (existing) file content from
     a github repository.
     """
-    repo = github_client.get_repo(gh_filter(repo))
     try:
-        # Retrieve existing file content
-        file = repo.get_contents(file_path)
+        # Retrieve existing file content (sha must be the current one)
+        file = gh_get_contents(github_client,repo,file_path,revalidate=True)
         # Update the file on GitHub
-        repo.update_file(file.path, commit_message, new_content, file.sha)
+        gh_get_repo(github_client,repo).update_file(file.path, commit_message, new_content, file.sha)
+        gh_track(github_client)
+        gh_cache_drop(id(github_client), "contents", gh_filter(repo), file_path)
         return {"status": True, "message": "Success"}
     except Exception as e:
         return {"status": False, "message": str(e)}
 
+def gh_commit_files(github_client,repo,files,commit_message,branch=None):
+    """
+    Update (or create) any number of files of a github repository
+    in a single commit, through the Git Data API (one tree and one
+    commit), so that the repository changes (and triggers builds) once.
+
+    files is a dict of path: new content. Commits to the default
+    branch unless a branch is given.
+    """
+    repo_name = gh_filter(repo)
+    try:
+        repo = gh_get_repo(github_client,repo_name)
+        branch = branch or repo.default_branch
+        # Head commit and its tree in one request.
+        head = repo.get_branch(branch).commit.commit
+        elements = [InputGitTreeElement(path, "100644", "blob", content=content) for path, content in files.items()]
+        tree = repo.create_git_tree(elements, head.tree)
+        commit = repo.create_git_commit(commit_message, tree, [head])
+        repo.get_git_ref(f"heads/{branch}").edit(commit.sha)
+        gh_track(github_client, count=5)
+        for path in files:
+            gh_cache_drop(id(github_client), "contents", repo_name, path)
+        return {"status": True, "message": commit.sha}
+    except Exception as e:
+        return {"status": False, "message": str(e)}
+
 def gh_get_jb_config(github_client,repo):
     """
     Get Jupyter Book configuration YAML file content 
@@ -237,6 +499,16 @@ def gh_update_jb_toc(github_client,repo,content):
     response = gh_update_file_content(github_client,repo,"content/_toc.yml",updated_config,":robot: [Automated] JB TOC update")
     return response
 
+def gh_update_jb_config_toc(github_client,repo,config,toc):
+    """
+    Update both the Jupyter Book configuration and TOC YAML
+    files (under the content directory) in a single commit.
+    """
+    files = {"content/_config.yml": yaml.dump(config),
+             "content/_toc.yml": yaml.dump(toc)}
+    response = gh_commit_files(github_client,repo,files,":robot: [Automated] JB configuration and TOC update")
+    return response
+
 def gh_get_paper_markdown(github_client,repo):
     """
     Get paper.md content from the root of the target repository
@@ -262,9 +534,11 @@ def gh_read_from_issue_body(github_client,issue_repo,issue_id,tag):
     Returns None if:
         - a requested tag does not exist 
         - the value is Pending
+
+    The issue is always revalidated (conditional request), as
+    editors may have just changed the body the value drives.
     """
-    repo = github_client.get_repo(gh_filter(issue_repo))
-    issue = repo.get_issue(issue_id)
+    issue = gh_get_issue(github_client,issue_repo,issue_id,revalidate=True)
     issue_body = issue.body
     # OpenJournals convention.
     start_marker = f"<!--{tag}-->"
@@ -281,6 +555,6 @@ def gh_read_from_issue_body(github_client,issue_repo,issue_id,tag):
 
 
 def get_default_branch(github_client,repository):
-    repo = github_client.get_repo(gh_filter(repository))
+    repo = gh_get_repo(github_client,repository)
     default_branch = repo.default_branch
     return default_branch
\ No newline at end of file
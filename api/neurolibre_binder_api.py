@@ -0,0 +1,76 @@
+import functools
+import requests
+from flask import Response, Blueprint, current_app, jsonify, make_response
+from flask_apispec import doc, use_kwargs
+from flask_htpasswd import HtPasswdAuth
+from common import run_binder_build_preflight_checks
+from build_locks import build_lock_owner, build_lock_release
+from schema import BinderSchema
+from binder_sse import binder_events
+"""
+BinderHub build proxy of the production server.
+
+Forwarding the event stream of a BinderHub build lasts as long as
+the build, which would hold a sync gunicorn worker of the API for
+the whole repo2docker build. This blueprint is served on its own
+by wsgi_binder.py, with gevent workers (see neurolibre-binder.service)
+so that an idle stream costs a greenlet, and nginx sends the
+/api/binder/build requests there.
+
+The preprint API registers the blueprint as well, for the
+documentation.
+"""
+
+binder_api = Blueprint('binder_api', __name__)
+
+@binder_api.before_app_first_request
+def setup_htpasswd_auth():
+    binder_api.htpasswd_auth = HtPasswdAuth(current_app)
+
+def require_http_auth(view_func):
+    @functools.wraps(view_func)
+    def wrapper(*args, **kwargs):
+        return binder_api.htpasswd_auth.required(view_func)(*args, **kwargs)
+    return wrapper
+
+# This is named as a binder/build instead of /book/build due to its context
+# Production server BinderHub deployment does not build a book.
+@binder_api.route('/api/binder/build', methods=['POST'])
+@require_http_auth
+@doc(description='Request a binderhub build on the production server for a given repo and hash. Repository must belong to the roboneurolibre organization.', tags=['Binder'])
+@use_kwargs(BinderSchema())
+def api_binder_build(user,repo_url, commit_hash):
+
+    binderName = current_app.config["BINDER_NAME"]
+    domainName = current_app.config["BINDER_DOMAIN"]
+    build_rate_limit = current_app.config["RATE_LIMIT"]
+    # The generator runs after the request context is gone.
+    logger = current_app.logger
+
+    lock_owner = build_lock_owner()
+    binderhub_request = run_binder_build_preflight_checks(repo_url,commit_hash,build_rate_limit, binderName, domainName, lock_owner=lock_owner)
+
+    # Request build from the preview binderhub instance
+    logger.info(f"Starting BinderHub request at {binderhub_request } ...")
+
+    response = requests.get(binderhub_request, stream=True)
+    if not response.ok:
+        build_lock_release(repo_url, lock_owner)
+        return make_response(jsonify(f"BinderHub request failed: {response.status_code} {response.reason}"),502)
+
+    # Forward the response as an event stream
+    def generate():
+        for event in binder_events(binderhub_request, response=response):
+            if event.get('phase') == 'failed':
+                # Remove the lock as binder build failed.
+                logger.info(f"[FAILED] BinderHub build {binderhub_request}.")
+                build_lock_release(repo_url, lock_owner)
+                return
+            message = event.get('message')
+            if message:
+                # Only print when phase emits a message to
+                # keep the logs neat.
+                yield message
+
+    build_lock_release(repo_url, lock_owner)
+    return Response(generate(), mimetype='text/event-stream')
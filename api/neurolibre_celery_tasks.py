@@ -9,6 +9,12 @@ import datetime
 from github_client import *
 from common import *
 from preprint import *
+from build_registry import registry_record, commit_from_image
+from build_events import build_event_publish
+from build_locks import build_lock_release, build_inflight_finish
+from task_slots import issue_fair
+from binder_sse import binder_events, binder_phase_update, binder_phase_durations
+from storage import DATA_ROOT, PREVIEW_DATA_ROOT, preview_book_roots, book_dir, book_repo_dir, data_dir, doi_dir, data_path, binder_log_path, binder_log_url
 from github import Github, UnknownObjectException
 from dotenv import load_dotenv
 import logging
@@ -38,6 +44,23 @@ celery_app = Celery('neurolibre_celery_tasks', backend='redis://localhost:6379/1
 
 celery_app.conf.update(task_track_started=True)
 
+# Queues by cost class, each consumed by a dedicated worker pool
+# (see systemd/*_celery.service), so that hours long uploads or
+# builds do not hold up the quick tasks:
+#   fast     GitHub and Zenodo API calls, seconds to minutes.
+#   build    BinderHub and Jupyter Book builds (preview server).
+#   long_io  Data and book syncs, Zenodo uploads (docker exports).
+celery_app.conf.update(task_default_queue="fast",
+                       task_routes={"neurolibre_celery_tasks.preview_build_book_task": {"queue": "build"},
+                                    "neurolibre_celery_tasks.preview_build_book_test_task": {"queue": "build"},
+                                    "neurolibre_celery_tasks.rsync_data_task": {"queue": "long_io"},
+                                    "neurolibre_celery_tasks.rsync_book_task": {"queue": "long_io"},
+                                    "neurolibre_celery_tasks.zenodo_upload_book_task": {"queue": "long_io"},
+                                    "neurolibre_celery_tasks.zenodo_upload_repository_task": {"queue": "long_io"},
+                                    "neurolibre_celery_tasks.zenodo_upload_docker_task": {"queue": "long_io"}},
+                       # A worker does not reserve tasks while it is busy with a long one.
+                       worker_prefetch_multiplier=1)
+
 """
 Configuration END
 """
@@ -64,25 +87,26 @@ def sleep_task(self, seconds):
     return 'done sleeping for {} seconds'.format(seconds)
 
 @celery_app.task(bind=True)
+@issue_fair
 def rsync_data_task(self, comment_id, issue_id, project_name, reviewRepository):
     """
     Uploading data to the production server 
     from the test server.
     """
     task_title = "DATA TRANSFER (Preview --> Preprint)"
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = gh_get_client()
     task_id = self.request.id
-    remote_path = os.path.join("neurolibre-preview:", "DATA", project_name)
+    remote_path = f"neurolibre-preview:{os.path.join(PREVIEW_DATA_ROOT, project_name)}"
     try:
         # TODO: improve this, subpar logging.
-        f = open("/DATA/data_synclog.txt", "a")
+        f = open(data_path("data_synclog.txt"), "a")
         f.write(remote_path)
         f.close()
         now = get_time()
         self.update_state(state=states.STARTED, meta={'message': f"Transfer started {now}"})
         gh_template_respond(github_client,"started",task_title,reviewRepository,issue_id,task_id,comment_id, "")
-        process = subprocess.Popen(["/usr/bin/rsync", "-avR", remote_path, "/"], stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+        # Data roots may differ between the servers, sync into the local one.
+        process = subprocess.Popen(["/usr/bin/rsync", "-av", remote_path, DATA_ROOT + "/"], stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
         output = process.communicate()[0]
         ret = process.wait()
         #logging.info(output)
@@ -90,8 +114,8 @@ def rsync_data_task(self, comment_id, issue_id, project_name, reviewRepository):
         gh_template_respond(github_client,"failure",task_title,reviewRepository,issue_id,task_id,comment_id, f"{e.output}")
         self.update_state(state=states.FAILURE, meta={'message': e.output})
     # Performing a final check
-    if os.path.exists(os.path.join("/DATA", project_name)):
-        if len(os.listdir(os.path.join("/DATA", project_name))) == 0:
+    if os.path.exists(data_dir(project_name)):
+        if len(os.listdir(data_dir(project_name))) == 0:
             # Directory exists but empty
             self.update_state(state=states.FAILURE, meta={'message': f"Directory exists but empty {project_name}"})
             gh_template_respond(github_client,"failure",task_title,reviewRepository,issue_id,task_id,comment_id, f"Directory exists but empty: {project_name}")
@@ -105,6 +129,7 @@ def rsync_data_task(self, comment_id, issue_id, project_name, reviewRepository):
         gh_template_respond(github_client,"failure",task_title,reviewRepository,issue_id,task_id,comment_id, f"Directory does not exist: {project_name}")
 
 @celery_app.task(bind=True)
+@issue_fair
 def rsync_book_task(self, repo_url, commit_hash, comment_id, issue_id, reviewRepository, server):
     """
     Moving the book from the test to the production
@@ -116,8 +141,7 @@ def rsync_book_task(self, repo_url, commit_hash, comment_id, issue_id, reviewRep
     to enable DOI formatted links.
     """
     task_title = "REPRODUCIBLE PREPRINT TRANSFER (Preview --> Preprint)"
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = gh_get_client()
     task_id = self.request.id
     [owner,repo,provider] = get_owner_repo_provider(repo_url,provider_full_name=True)
     if owner != "roboneurolibre": 
@@ -126,24 +150,33 @@ def rsync_book_task(self, repo_url, commit_hash, comment_id, issue_id, reviewRep
         return
     commit_hash = format_commit_hash(repo_url,commit_hash)
     logging.info(f"{owner}{provider}{repo}{commit_hash}")
-    remote_path = os.path.join("neurolibre-preview:", "DATA", "book-artifacts", owner, provider, repo, commit_hash + "*")
+    # Lands on whichever storage root this repository is placed on.
+    local_repo_dir = book_repo_dir(owner, provider, repo)
     try:
-        # TODO: improve this, subpar logging.
-        f = open("/DATA/synclog.txt", "a")
-        f.write(remote_path)
-        f.close()
         now = get_time()
         self.update_state(state=states.STARTED, meta={'message': f"Transfer started {now}"})
         gh_template_respond(github_client,"started",task_title,reviewRepository,issue_id,task_id,comment_id, "")
-        #logging.info("Calling subprocess")
-        process = subprocess.Popen(["/usr/bin/rsync", "-avR", remote_path, "/"], stdout=subprocess.PIPE,stderr=subprocess.STDOUT) 
-        output = process.communicate()[0]
-        ret = process.wait()
-        logging.info(output)
+        os.makedirs(local_repo_dir, exist_ok=True)
+        # The book is on one of the preview book roots.
+        for preview_root in preview_book_roots(owner, provider, repo):
+            remote_path = f"neurolibre-preview:{os.path.join(preview_root, owner, provider, repo, commit_hash)}*"
+            # TODO: improve this, subpar logging.
+            f = open(data_path("synclog.txt"), "a")
+            f.write(remote_path)
+            f.close()
+            #logging.info("Calling subprocess")
+            process = subprocess.Popen(["/usr/bin/rsync", "-av", remote_path, local_repo_dir + "/"], stdout=subprocess.PIPE,stderr=subprocess.STDOUT) 
+            output = process.communicate()[0]
+            ret = process.wait()
+            logging.info(output)
+            if ret == 0:
+                break
     except subprocess.CalledProcessError as e:
         #logging.info("Subprocess exception")
         gh_template_respond(github_client,"failure",task_title,reviewRepository,issue_id,task_id,comment_id, f"{e.output}")
         self.update_state(state=states.FAILURE, meta={'message': e.output})
+    # Register the synced book to the catalog of this server
+    book_ingest(owner, provider, repo, commit_hash)
     # Check if GET works for the complicated address
     results = book_get_by_params(commit_hash=commit_hash)
     if not results:
@@ -151,9 +184,9 @@ def rsync_book_task(self, repo_url, commit_hash, comment_id, issue_id, reviewRep
         gh_template_respond(github_client,"failure",task_title,reviewRepository,issue_id,task_id,comment_id, f"Cannot retreive book at {commit_hash}")
     else:
         # Symlink production book to attain a proper URL
-        book_path = os.path.join("/DATA", "book-artifacts", owner, provider, repo, commit_hash , "_build" , "html")
+        book_path = os.path.join(book_dir(owner, provider, repo, commit_hash), "_build" , "html")
         iid = "{:05d}".format(issue_id)
-        doi_path =  os.path.join("/DATA","10.55458",f"neurolibre.{iid}")
+        doi_path = doi_dir(issue_id)
         process_mkd = subprocess.Popen(["mkdir", doi_path], stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
         output_mkd = process_mkd.communicate()[0]
         ret_mkd = process_mkd.wait()
@@ -174,64 +207,72 @@ def rsync_book_task(self, repo_url, commit_hash, comment_id, issue_id, reviewRep
             self.update_state(state=states.FAILURE, meta={'message': f"Cannot sync book at {commit_hash}"})
             gh_template_respond(github_client,"failure",task_title,reviewRepository,issue_id,task_id,comment_id, output)
 
-@celery_app.task(bind=True)
-def fork_configure_repository_task(self, source_url, comment_id, issue_id, reviewRepository):
+# Forks are created asynchronously by GitHub, readiness is checked
+# FORK_CHECK_START, 2x, 4x... seconds after forking (~2 minutes overall).
+FORK_CHECK_START = 0.5
+FORK_CHECK_RETRIES = 8
+
+@celery_app.task(bind=True, max_retries=FORK_CHECK_RETRIES)
+def fork_configure_repository_task(self, source_url, comment_id, issue_id, reviewRepository, forked=False):
+    """
+    Fork the source repository into GH_ORGANIZATION and configure
+    the book of the fork for production. While GitHub is creating
+    the fork, the task re-schedules itself (exponential backoff)
+    instead of sleeping, so that the worker is free in between.
+    """
     task_title = "INITIATE PRODUCTION (Fork and Configure)"
     
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = gh_get_client()
     task_id = self.request.id
-    
-    now = get_time()
-    self.update_state(state=states.STARTED, meta={'message': f"Transfer started {now}"})
-    gh_template_respond(github_client,"started",task_title,reviewRepository,issue_id,task_id,comment_id, "")
-    
     forked_name = gh_forkify_name(source_url)
-    # First check if a fork already exists.
-    fork_exists  = False
-    try: 
-        github_client.get_repo(forked_name)
-        fork_exists = True
-    except UnknownObjectException as e:
-        gh_template_respond(github_client,"started",task_title,reviewRepository,issue_id,task_id,comment_id, "Started forking into roboneurolibre.")
-        logging.info(e.data['message'] + "--> Forking")
-
-    if not fork_exists:
-        try:
-            forked_repo = gh_fork_repository(github_client,source_url)
-        except Exception as e:
-            gh_template_respond(github_client,"failure",task_title,reviewRepository,issue_id,task_id,comment_id, f"Cannot fork the repository into {GH_ORGANIZATION}! \n {str(e)}")
-            self.request.revoke(terminate=True)
-            return
 
-        forked_repo = None
-        retry_count = 0
-        max_retries = 5
+    if not forked:
+        now = get_time()
+        self.update_state(state=states.STARTED, meta={'message': f"Transfer started {now}"})
+        gh_template_respond(github_client,"started",task_title,reviewRepository,issue_id,task_id,comment_id, "")
 
-        while retry_count < max_retries and not forked_repo:
-            time.sleep(15)
-            retry_count += 1
+    # One request, also tells if the fork is ready to be configured.
+    if not gh_fork_ready(github_client,source_url):
+        if not forked:
+            gh_template_respond(github_client,"started",task_title,reviewRepository,issue_id,task_id,comment_id, "Started forking into roboneurolibre.")
+            logging.info(f"{forked_name} does not exist --> Forking")
             try:
-                forked_repo = github_client.get_repo(forked_name)
-            except Exception:
-                pass
-
-        if not forked_repo and retry_count == max_retries:
-            gh_template_respond(github_client,"failure",task_title,reviewRepository,issue_id,task_id,comment_id, f"Forked repository is still not available after {max_retries*15} seconds! Please check if the repository is available under roboneurolibre organization, then try again.")
+                gh_fork_repository(github_client,source_url)
+            except Exception as e:
+                gh_template_respond(github_client,"failure",task_title,reviewRepository,issue_id,task_id,comment_id, f"Cannot fork the repository into {GH_ORGANIZATION}! \n {str(e)}")
+                self.request.revoke(terminate=True)
+                return
+        if self.request.retries >= FORK_CHECK_RETRIES:
+            waited = FORK_CHECK_START * (2 ** FORK_CHECK_RETRIES - 1)
+            gh_template_respond(github_client,"failure",task_title,reviewRepository,issue_id,task_id,comment_id, f"Forked repository is still not available after {waited:.0f} seconds! Please check if the repository is available under roboneurolibre organization, then try again.")
             self.request.revoke(terminate=True)
             return
-    else:
+        raise self.retry(kwargs={'forked': True}, countdown=FORK_CHECK_START * 2 ** self.request.retries)
+    elif not forked:
         logging.info(f"Fork already exists {source_url}, moving on with configurations.")
     
     gh_template_respond(github_client,"started",task_title,reviewRepository,issue_id,task_id,comment_id, "Forked repo has become available. Proceeding with configuration updates.")
 
+    response = configure_fork(github_client,forked_name,issue_id)
+
+    if not response['status']:
+        gh_template_respond(github_client,"failure",task_title,reviewRepository,issue_id,task_id,comment_id, response['message'])
+        self.request.revoke(terminate=True)
+        return
+    
+    gh_template_respond(github_client,"success",task_title,reviewRepository,issue_id,task_id,comment_id, f"Please confirm that the <a href=\"https://github.com/{forked_name}\">forked repository</a> is available and (<code>_toc.yml</code> and <code>_config.ymlk</code>) properly configured.")
+
+def configure_fork(github_client,forked_name,issue_id):
+    """
+    Configure the book of a fork for production (production BinderHub,
+    repository URL and a TOC entry for the citable PDF and archives).
+    Returns a dict with status and message, as the gh_update_* helpers.
+    """
     jb_config = gh_get_jb_config(github_client,forked_name)
     jb_toc = gh_get_jb_toc(github_client,forked_name)
 
     if not jb_config or not jb_toc:
-        gh_template_respond(github_client,"failure",task_title,reviewRepository,issue_id,task_id,comment_id, f"Could not load _config.yml or _toc.yml under the content directory of {forked_name}")
-        self.request.revoke(terminate=True)
-        return
+        return {"status": False, "message": f"Could not load _config.yml or _toc.yml under the content directory of {forked_name}"}
 
     if not jb_config['launch_buttons']:
         jb_config['launch_buttons'] = {}
@@ -244,14 +285,6 @@ def fork_configure_repository_task(self, source_url, comment_id, issue_id, revie
         jb_config['repository'] = {}
     jb_config['repository']['url'] = f"https://github.com/{forked_name}"
 
-    # Update configuration file in the forked repo
-    response = gh_update_jb_config(github_client,forked_name,jb_config)
-
-    if not response['status']:
-        gh_template_respond(github_client,"failure",task_title,reviewRepository,issue_id,task_id,comment_id, f"Could not update _config.yml for {forked_name}: \n {response['message']}")
-        self.request.revoke(terminate=True)
-        return
-
     if 'parts' in jb_toc:
         jb_toc['parts'].append({
             "caption": JOURNAL_NAME,
@@ -273,146 +306,107 @@ def fork_configure_repository_task(self, source_url, comment_id, issue_id, revie
             "title": "Citable PDF and archives"
         })
     
-    # Update TOC file in the forked repo
-    response = gh_update_jb_toc(github_client,forked_name,jb_toc)
+    # Update configuration and TOC files in the forked repo (single commit)
+    response = gh_update_jb_config_toc(github_client,forked_name,jb_config,jb_toc)
 
     if not response['status']:
-        gh_template_respond(github_client,"failure",task_title,reviewRepository,issue_id,task_id,comment_id, f"Could not update toc.yml for {forked_name}: \n {response['message']}")
-        self.request.revoke(terminate=True)
-        return
-    
-    gh_template_respond(github_client,"success",task_title,reviewRepository,issue_id,task_id,comment_id, f"Please confirm that the <a href=\"https://github.com/{forked_name}\">forked repository</a> is available and (<code>_toc.yml</code> and <code>_config.ymlk</code>) properly configured.")
+        response['message'] = f"Could not update _config.yml and _toc.yml for {forked_name}: \n {response['message']}"
+    return response
 
-def binder_stream(response, github_client,lock_filename, task_id, payload):
-    start_time = time.time()
-    messages = []
-    n_updates = 0
-    for line in response.iter_lines():
-        if line:
-            event_string = line.decode("utf-8")
-            try:
-                event = json.loads(event_string.split(': ', 1)[1])
-                # https://binderhub.readthedocs.io/en/latest/api.html
-                if event.get('phase') == 'failed':
-                    message = event.get('message')
-                    response.close()
-                    messages.append(message)
-                    gh_template_respond(github_client,"failure","Binder build has failed &#129344;",payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], messages)
-                    # Remove the lock as binder build failed.
-                    #app.logger.info(f"[FAILED] BinderHub build {binderhub_request}.")
-                    os.remove(lock_filename)
-                    return
-                message = event.get('message')
-                if message:
-                    yield message
-                    messages.append(message)
-                    elapsed_time = time.time() - start_time
-                    # Update issue every two minutes
-                    if elapsed_time >= 120:
-                        n_updates = n_updates + 1
-                        gh_template_respond(github_client,"started",payload['task_title'] + f" {n_updates*2} minutes passed",payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], messages)
-                        start_time = time.time()
-            except GeneratorExit:
-                pass
-            except:
-                pass
-
-"""
-TODO IMPORTANT 
-
-EITHER CALL GENERATOR MULTIPLE TIMES, OR MOVE IT TO THE 
-BODY OF THE TASK, OTHERWISE UPDATES ARE NOT RECEIVED. 
-"""
 @celery_app.task(bind=True)
+@issue_fair
 def preview_build_book_task(self, payload):
 
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = gh_get_client()
     task_id = self.request.id
-    binderhub_request = run_binder_build_preflight_checks(payload['repo_url'],
-                                                          payload['commit_hash'],
-                                                          payload['rate_limit'],
-                                                          payload['binder_name'],
-                                                          payload['domain_name'])
-    lock_filename = get_lock_filename(payload['repo_url'])
-    response = requests.get(binderhub_request, stream=True)
-    gh_template_respond(github_client,"started",payload['task_title'],payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], f"Running for: {binderhub_request}")
-    if response.ok:
-        # Create binder_stream generator object
-        def generate():
-            #start_time = time.time()
-            #messages = []
-            #n_updates = 0
-            for line in response.iter_lines():
-                if line:
-                    event_string = line.decode("utf-8")
-                    try:
-                        event = json.loads(event_string.split(': ', 1)[1])
-                        # https://binderhub.readthedocs.io/en/latest/api.html
-                        if event.get('phase') == 'failed':
-                            message = event.get('message')
-                            yield message
-                            response.close()
-                            #messages.append(message)
-                            #gh_template_respond(github_client,"failure","Binder build has failed &#129344;",payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], messages)
-                            # Remove the lock as binder build failed.
-                            #app.logger.info(f"[FAILED] BinderHub build {binderhub_request}.")
-                            os.remove(lock_filename)
-                            return
-                        message = event.get('message')
-                        if message:
-                            yield message
-                            #messages.append(message)
-                            #elapsed_time = time.time() - start_time
-                            # Update issue every two minutes
-                            #if elapsed_time >= 120:
-                            #    n_updates = n_updates + 1
-                            #    gh_template_respond(github_client,"started",payload['task_title'] + f" {n_updates*2} minutes passed",payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], messages)
-                            #    start_time = time.time()
-                    except GeneratorExit:
-                        pass
-                    except:
-                        pass
-        # Use the generator object as the source of flask eventstream response
-        binder_response = Response(generate(), mimetype='text/event-stream')
-        # Fetch all the yielded messages
-    binder_logs = binder_response.get_data(as_text=True)
-    binder_logs = "".join(binder_logs)
-    # After the upstream closes, check the server if there's 
-    # a book built successfully.
-    book_status = book_get_by_params(commit_hash=payload['commit_hash'])
-    # For now, remove the block either way.
-    # The main purpose is to avoid triggering
-    # a build for the same request. Later on
-    # you may choose to add dead time after a successful build.
-    os.remove(lock_filename)
-        # Append book-related response downstream
-    if not book_status:
-        # These flags will determine how the response will be 
-        # interpreted and returned outside the generator
-        gh_template_respond(github_client,"failure","Binder build has failed &#129344;",payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], "The next comment will forward the logs")
-        issue_comment = []
-        msg = f"<p>&#129344; We ran into a problem building your book. Please see the log files below.</p><details><summary> <b>BinderHub build log</b> </summary><pre><code>{binder_logs}</code></pre></details><p>If the BinderHub build looks OK, please see the Jupyter Book build log(s) below.</p>"
-        issue_comment.append(msg)
+    try:
         owner,repo,provider = get_owner_repo_provider(payload['repo_url'],provider_full_name=True)
-        # Retreive book build and execution report logs.
-        book_logs = book_log_collector(owner,repo,provider,payload['commit_hash'])
-        issue_comment.append(book_logs)
-        msg = "<p>&#128030; After inspecting the logs above, you can interactively debug your notebooks on our <a href=\"https://binder.conp.cloud\">BinderHub server</a>.</p> <p>For guidelines, please see <a href=\"https://docs.neurolibre.org/en/latest/TEST_SUBMISSION.html#debugging-for-long-neurolibre-submission\">the relevant documentation.</a></p>"
-        issue_comment.append(msg)
-        issue_comment = "\n".join(issue_comment)
-        # Send a new comment
-        gh_create_comment(github_client, payload['review_repository'],payload['issue_id'],issue_comment)
-    else:
-        gh_template_respond(github_client,"success","Successfully built", payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], f"The next comment will forward the logs")
-        issue_comment = []
-        gh_create_comment(github_client, payload['review_repository'],payload['issue_id'],book_status[0]['book_url'])
+        binderhub_request = run_binder_build_preflight_checks(payload['repo_url'],
+                                                              payload['commit_hash'],
+                                                              payload['rate_limit'],
+                                                              payload['binder_name'],
+                                                              payload['domain_name'],
+                                                              lock_owner=task_id)
+        response = requests.get(binderhub_request, stream=True)
+        gh_template_respond(github_client,"started",payload['task_title'],payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], f"Running for: {binderhub_request}")
+        # Events are published to the watchers of the build (see build_events.py),
+        # phase transitions to the task meta, so that their durations can be measured.
+        phases = []
+        def on_event(event):
+            build_event_publish(task_id, event)
+            binder_phase_update(self, phases, event)
+        # Written to disk as it arrives, only the tail is kept in memory.
+        binder_build = binder_log_spool(binder_events(binderhub_request, response=response), binder_log_path(task_id), on_event=on_event)
+        binder_logs = binder_build['tail']
+        durations = binder_phase_durations(phases)
+        logging.info(f"BinderHub build phases of {task_id}: {durations}")
+        # After the upstream closes, register the book (if any) 
+        # to the catalog and check if it was built successfully.
+        book_ingest(owner, provider, repo, payload['commit_hash'])
+        book_status = book_get_by_params(commit_hash=payload['commit_hash'])
+        # Docker image and data of successful builds are looked up by the preprint server.
+        docker_image = binder_build['docker_image']
+        registry_record(payload['repo_url'],
+                        commit_from_image(docker_image or "") or payload['commit_hash'],
+                        docker_image,
+                        "success" if book_status else "failure")
+        build_event_publish(task_id, {"status": "success" if book_status else "failure",
+                                      "book": book_status[0] if book_status else None,
+                                      "log_url": binder_log_url(task_id),
+                                      "durations": durations}, event="end")
+        # For now, remove the block either way.
+        # The main purpose is to avoid triggering
+        # a build for the same request. Later on
+        # you may choose to add dead time after a successful build.
+        build_lock_release(payload['repo_url'], task_id)
+        # Requests for the same commit that attached to this build get the same outcome.
+        for watcher in build_inflight_finish(payload['repo_url'], payload['commit_hash'], task_id):
+            if book_status:
+                gh_template_respond(github_client,"success","Successfully built",watcher['review_repository'],watcher['issue_id'],task_id,watcher['comment_id'], book_status[0]['book_url'])
+            else:
+                gh_template_respond(github_client,"failure","Binder build has failed &#129344;",watcher['review_repository'],watcher['issue_id'],task_id,watcher['comment_id'], f"Logs are forwarded to issue #{payload['issue_id']}, see also the <a href=\"{binder_log_url(task_id)}\">BinderHub build log</a>.")
+            # Append book-related response downstream
+        if not book_status:
+            # These flags will determine how the response will be 
+            # interpreted and returned outside the generator
+            gh_template_respond(github_client,"failure","Binder build has failed &#129344;",payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], "The next comment will forward the logs")
+            issue_comment = []
+            msg = f"<p>&#129344; We ran into a problem building your book. Please see the log files below.</p><details><summary> <b>BinderHub build log</b> (last {BINDER_LOG_TAIL} lines, see the <a href=\"{binder_log_url(task_id)}\">full log</a>)</summary><pre><code>{binder_logs}</code></pre></details><p>If the BinderHub build looks OK, please see the Jupyter Book build log(s) below.</p>"
+            issue_comment.append(msg)
+            owner,repo,provider = get_owner_repo_provider(payload['repo_url'],provider_full_name=True)
+            # Retreive book build and execution report logs.
+            book_logs = book_log_collector(owner,repo,provider,payload['commit_hash'])
+            issue_comment.append(book_logs)
+            msg = "<p>&#128030; After inspecting the logs above, you can interactively debug your notebooks on our <a href=\"https://binder.conp.cloud\">BinderHub server</a>.</p> <p>For guidelines, please see <a href=\"https://docs.neurolibre.org/en/latest/TEST_SUBMISSION.html#debugging-for-long-neurolibre-submission\">the relevant documentation.</a></p>"
+            issue_comment.append(msg)
+            issue_comment = "\n".join(issue_comment)
+            # Send a new comment
+            gh_create_comment(github_client, payload['review_repository'],payload['issue_id'],issue_comment)
+        else:
+            gh_template_respond(github_client,"success","Successfully built", payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], f"The next comment will forward the logs")
+            issue_comment = []
+            gh_create_comment(github_client, payload['review_repository'],payload['issue_id'],book_status[0]['book_url'])
+        return {"phases": phases, "durations": durations}
+    except Exception as e:
+        # E.g., the preflight checks aborted (HTTPException) or BinderHub
+        # could not be reached: the requests that attached to this build
+        # must not wait for an outcome that never comes.
+        reason = getattr(e, 'description', None) or str(e)
+        build_event_publish(task_id, {"status": "failure", "book": None, "reason": reason}, event="end")
+        for watcher in build_inflight_finish(payload['repo_url'], payload['commit_hash'], task_id):
+            gh_template_respond(github_client,"failure","Binder build could not run &#129344;",watcher['review_repository'],watcher['issue_id'],task_id,watcher['comment_id'], reason)
+        gh_template_respond(github_client,"failure","Binder build could not run &#129344;",payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], reason)
+        raise
+    finally:
+        # No-ops if already done above, or if the lock and
+        # the claim are held by another task.
+        build_lock_release(payload['repo_url'], task_id)
+        build_inflight_finish(payload['repo_url'], payload['commit_hash'], task_id)
 
 @celery_app.task(bind=True)
 def zenodo_create_buckets_task(self, payload):
     
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = gh_get_client()
     task_id = self.request.id
 
     gh_template_respond(github_client,"started",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'])
@@ -464,6 +458,11 @@ def zenodo_create_buckets_task(self, payload):
         if author.get('orcid') is None:
             author.pop('orcid')
 
+    # Same commits for all the archive types, resolved once.
+    owner,repo,provider = get_owner_repo_provider(payload['repository_url'],provider_full_name=True)
+    commit_user = format_commit_hash(payload['repository_url'],"HEAD",cached=True)
+    commit_fork = format_commit_hash(f"https://{provider}/roboneurolibre/{repo}","HEAD",cached=True)
+
     collect = {}
     for archive_type in payload['archive_assets']:
                 gh_template_respond(github_client,"started",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], f"Creating Zenodo buckets for {archive_type}")
@@ -471,7 +470,9 @@ def zenodo_create_buckets_task(self, payload):
                                          archive_type,
                                          data['authors'],
                                          payload['repository_url'],
-                                         payload['issue_id'])
+                                         payload['issue_id'],
+                                         commit_user,
+                                         commit_fork)
                 collect[archive_type] = r
                 # Rate limit
                 time.sleep(2)
@@ -491,16 +492,19 @@ def zenodo_create_buckets_task(self, payload):
         gh_template_respond(github_client,"failure",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], f"{collect}")
     else:
         # This means that all requested deposits are successful
+        # Pin the commit, uploads and publish read it from the record.
+        for archive_type in collect:
+            collect[archive_type][DEPOSIT_COMMIT_KEY] = commit_fork
         print(f'Writing {local_file}...')
         with open(local_file, 'w') as outfile:
             json.dump(collect, outfile)
         gh_template_respond(github_client,"success",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], f"Zenodo records have been created successfully: \n {collect}")
 
 @celery_app.task(bind=True)
+@issue_fair
 def zenodo_upload_book_task(self, payload):
 
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = gh_get_client()
     task_id = self.request.id
     
     gh_template_respond(github_client,"started",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'])
@@ -508,9 +512,10 @@ def zenodo_upload_book_task(self, payload):
     owner,repo,provider = get_owner_repo_provider(payload['repository_url'],provider_full_name=True)
     
     fork_url = f"https://{provider}/roboneurolibre/{repo}"
-    commit_fork = format_commit_hash(fork_url,"HEAD")
+    # Pinned when the buckets were created.
+    commit_fork = get_deposit_commit(payload['issue_id'],fork_url)
 
-    local_path = os.path.join("/DATA", "book-artifacts", "roboneurolibre", provider, repo, commit_fork, "_build", "html")
+    local_path = os.path.join(book_dir("roboneurolibre", provider, repo, commit_fork), "_build", "html")
     # Descriptive file name
     zenodo_file = os.path.join(get_archive_dir(payload['issue_id']),f"JupyterBook_10.55458_NeuroLibre_{payload['issue_id']:05d}_{commit_fork[0:6]}")
     # Zip it!
@@ -529,10 +534,10 @@ def zenodo_upload_book_task(self, payload):
         gh_template_respond(github_client,"success",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], f"Successful {zpath} to {payload['bucket_url']}")
     
 @celery_app.task(bind=True)
+@issue_fair
 def zenodo_upload_repository_task(self, payload):
 
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = gh_get_client()
     task_id = self.request.id
     
     gh_template_respond(github_client,"started",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'])
@@ -540,11 +545,11 @@ def zenodo_upload_repository_task(self, payload):
     owner,repo,provider = get_owner_repo_provider(payload['repository_url'],provider_full_name=True)
     
     fork_url = f"https://{provider}/roboneurolibre/{repo}"
-    commit_fork = format_commit_hash(fork_url,"HEAD")
+    # Pinned when the buckets were created.
+    commit_fork = get_deposit_commit(payload['issue_id'],fork_url)
     
-    default_branch = get_default_branch(github_client,fork_url)
-
-    download_url = f"{fork_url}/archive/refs/heads/{default_branch}.zip"
+    # Archive of the pinned commit, the branch may have moved since.
+    download_url = f"{fork_url}/archive/{commit_fork}.zip"
 
     zenodo_file = os.path.join(get_archive_dir(payload['issue_id']),f"GitHubRepo_10.55458_NeuroLibre_{payload['issue_id']:05d}_{commit_fork[0:6]}.zip")
 
@@ -567,10 +572,10 @@ def zenodo_upload_repository_task(self, payload):
             gh_template_respond(github_client,"success",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], f"Successful {zenodo_file} to {payload['bucket_url']}")
 
 @celery_app.task(bind=True)
+@issue_fair
 def zenodo_upload_docker_task(self, payload):
 
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = gh_get_client()
     task_id = self.request.id
     
     gh_template_respond(github_client,"started",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'])
@@ -578,7 +583,8 @@ def zenodo_upload_docker_task(self, payload):
     owner,repo,provider = get_owner_repo_provider(payload['repository_url'],provider_full_name=True)
     
     fork_url = f"https://{provider}/roboneurolibre/{repo}"
-    commit_fork = format_commit_hash(fork_url,"HEAD")
+    # Pinned when the buckets were created.
+    commit_fork = get_deposit_commit(payload['issue_id'],fork_url)
 
     record_name = item_to_record_name("docker")
 
@@ -599,12 +605,13 @@ def zenodo_upload_docker_task(self, payload):
                     json.dump(response.json(), outfile)
             gh_template_respond(github_client,"success",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], f"Successful {tar_file} to {payload['bucket_url']}")
     else:
-        # Get the lookup_table.tsv entry (from the preview server) for the fork_url
-        lut = get_resource_lookup(PREVIEW_SERVER,True,fork_url)
+        # Get the build (from the preview server) of the fork_url at the pinned
+        # commit, so that the image is the one of the other archives.
+        lut = get_resource_lookup(PREVIEW_SERVER,True,fork_url,commit_hash=commit_fork)
 
         if not lut:
             # Terminate ERROR
-            msg = f"Looks like there's not a successful book build record for {fork_url}"
+            msg = f"Looks like there's not a successful book build record for {fork_url} at {commit_fork}"
             gh_template_respond(github_client,"failure",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], msg)
             self.request.revoke(terminate=True)
             return
@@ -666,8 +673,7 @@ def zenodo_upload_docker_task(self, payload):
 @celery_app.task(bind=True)
 def zenodo_publish_task(self, payload):
     
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = gh_get_client()
     task_id = self.request.id
     
     gh_template_respond(github_client,"started",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'])
@@ -711,69 +717,50 @@ def preview_build_book_test_task(self, payload):
                                                           payload['commit_hash'],
                                                           payload['rate_limit'],
                                                           payload['binder_name'],
-                                                          payload['domain_name'])
-    lock_filename = get_lock_filename(payload['repo_url'])
+                                                          payload['domain_name'],
+                                                          lock_owner=task_id)
     response = requests.get(binderhub_request, stream=True)
     mail_body = f"Runtime environment build has been started <code>{task_id}</code> If successful, it will be followed by the Jupyter Book build."
     send_email_celery(payload['email'],payload['mail_subject'],mail_body)
     #gh_template_respond(github_client,"started",payload['task_title'],payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], f"Running for: {binderhub_request}")
-    if response.ok:
-        # Create binder_stream generator object
-        def generate():
-            #start_time = time.time()
-            #messages = []
-            #n_updates = 0
-            for line in response.iter_lines():
-                if line:
-                    event_string = line.decode("utf-8")
-                    try:
-                        event = json.loads(event_string.split(': ', 1)[1])
-                        # https://binderhub.readthedocs.io/en/latest/api.html
-                        if event.get('phase') == 'failed':
-                            message = event.get('message')
-                            yield message
-                            response.close()
-                            #messages.append(message)
-                            #gh_template_respond(github_client,"failure","Binder build has failed &#129344;",payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], messages)
-                            # Remove the lock as binder build failed.
-                            #app.logger.info(f"[FAILED] BinderHub build {binderhub_request}.")
-                            os.remove(lock_filename)
-                            return
-                        message = event.get('message')
-                        if message:
-                            yield message
-                            #messages.append(message)
-                            #elapsed_time = time.time() - start_time
-                            # Update issue every two minutes
-                            #if elapsed_time >= 120:
-                            #    n_updates = n_updates + 1
-                            #    gh_template_respond(github_client,"started",payload['task_title'] + f" {n_updates*2} minutes passed",payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], messages)
-                            #    start_time = time.time()
-                    except GeneratorExit:
-                        pass
-                    except:
-                        pass
-        # Use the generator object as the source of flask eventstream response
-        binder_response = Response(generate(), mimetype='text/event-stream')
-        # Fetch all the yielded messages
-    binder_logs = binder_response.get_data(as_text=True)
-    binder_logs = "".join(binder_logs)
-    # After the upstream closes, check the server if there's 
-    # a book built successfully.
+    # Events are published to the watchers of the build (see build_events.py),
+    # phase transitions to the task meta, so that their durations can be measured.
+    phases = []
+    def on_event(event):
+        build_event_publish(task_id, event)
+        binder_phase_update(self, phases, event)
+    # Written to disk as it arrives, only the tail is kept in memory.
+    binder_build = binder_log_spool(binder_events(binderhub_request, response=response), binder_log_path(task_id), on_event=on_event)
+    binder_logs = binder_build['tail']
+    durations = binder_phase_durations(phases)
+    logging.info(f"BinderHub build phases of {task_id}: {durations}")
+    # After the upstream closes, register the book (if any) 
+    # to the catalog and check if it was built successfully.
+    book_ingest(owner, provider, repo, payload['commit_hash'])
     book_status = book_get_by_params(commit_hash=payload['commit_hash'])
+    # Docker image and data of successful builds are looked up by the preprint server.
+    docker_image = binder_build['docker_image']
+    registry_record(payload['repo_url'],
+                    commit_from_image(docker_image or "") or payload['commit_hash'],
+                    docker_image,
+                    "success" if book_status else "failure")
+    build_event_publish(task_id, {"status": "success" if book_status else "failure",
+                                  "book": book_status[0] if book_status else None,
+                                  "log_url": binder_log_url(task_id),
+                                  "durations": durations}, event="end")
     exec_error = book_execution_errored(owner,repo,provider,payload['commit_hash'])
     # For now, remove the block either way.
     # The main purpose is to avoid triggering
     # a build for the same request. Later on
     # you may choose to add dead time after a successful build.
-    os.remove(lock_filename)
+    build_lock_release(payload['repo_url'], task_id)
         # Append book-related response downstream
     if not book_status or exec_error:
         # These flags will determine how the response will be 
         # interpreted and returned outside the generator
         #gh_template_respond(github_client,"failure","Binder build has failed &#129344;",payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], "The next comment will forward the logs")
         issue_comment = []
-        msg = f"<p>&#129344; We ran into a problem building your book. Please see the log files below.</p><details><summary> <b>BinderHub build log</b> </summary><pre><code>{binder_logs}</code></pre></details><p>If the BinderHub build looks OK, please see the Jupyter Book build log(s) below.</p>"
+        msg = f"<p>&#129344; We ran into a problem building your book. Please see the log files below.</p><details><summary> <b>BinderHub build log</b> (last {BINDER_LOG_TAIL} lines, see the <a href=\"{binder_log_url(task_id)}\">full log</a>)</summary><pre><code>{binder_logs}</code></pre></details><p>If the BinderHub build looks OK, please see the Jupyter Book build log(s) below.</p>"
         issue_comment.append(msg)
         owner,repo,provider = get_owner_repo_provider(payload['repo_url'],provider_full_name=True)
         # Retreive book build and execution report logs.
@@ -791,6 +778,7 @@ def preview_build_book_test_task(self, payload):
         #issue_comment = []
         mail_body = f"Book build successful: {book_status[0]['book_url']}"
         send_email_celery(payload['email'],payload['mail_subject'],mail_body)
+    return {"phases": phases, "durations": durations}
 
 def send_email_celery(to_email, subject, body):
     sg_api_key = os.getenv('SENDGRID_API_KEY')
@@ -852,7 +840,7 @@ def send_email_with_html_attachment_celery(to_email, subject, body, attachment_p
 
 def write_html_to_temp_directory(commit_sha, logs):
     with tempfile.TemporaryDirectory() as temp_dir:
-        file_path = os.path.join("/DATA","api_build_logs", f"logs_{commit_sha[:7]}.html")
+        file_path = data_path("api_build_logs", f"logs_{commit_sha[:7]}.html")
 
         with open(file_path, "w+") as f:
             f.write("<!DOCTYPE html>\n")
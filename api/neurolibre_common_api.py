@@ -1,10 +1,18 @@
 from flask import Response, Blueprint, abort, jsonify, request, current_app, make_response
 from common import *
 from flask_apispec import marshal_with, doc, use_kwargs
-from urllib.parse import urlparse
-from schema import UnlockSchema, StatusSchema, BookSchema, TaskSchema
+import json
+import hashlib
+import functools
+import datetime
+from urllib.parse import urlparse, urlencode
+from werkzeug.http import is_resource_modified
+from schema import UnlockSchema, StatusSchema, BookSchema, BooksSchema, TaskSchema
 from flask_htpasswd import HtPasswdAuth
 from neurolibre_celery_tasks import celery_app, sleep_task
+from github_budget import gh_budget_report
+from build_locks import build_lock_remove, build_lock_status
+import redis
 
 common_api = Blueprint('common_api', __name__,
                         template_folder='./')
@@ -24,8 +32,10 @@ def setup_htpasswd_auth():
 
 
 # Decorate to require HTTP Basic Authentication for
-# common-api endpoints
+# common-api endpoints. Keeps the name of the view, which
+# is the endpoint name of the route.
 def require_http_auth(view_func):
+    @functools.wraps(view_func)
     def wrapper(*args, **kwargs):
         return common_api.htpasswd_auth.required(view_func)(*args, **kwargs)
     return wrapper
@@ -45,39 +55,115 @@ def api_heartbeat(id=None):
     return response
 
 @common_api.route('/api/books', methods=['GET'])
+@marshal_with(None,code=304,description="Not modified since the ETag or date given by the client.")
+@marshal_with(None,code=400,description="Bad request.")
 @marshal_with(None,code=404,description="Not found.")
-@marshal_with(None,code=200,description="Success.")
-@doc(description='Get the list of all the built books that exist on the server.', tags=['Book'])
-def api_get_books():
-    books = load_all()
+@marshal_with(None,code=200,description="Success. When paginated, the next page is given by the X-Next-Cursor and Link headers. With format=ndjson, books are streamed as newline delimited JSON.")
+@use_kwargs(BooksSchema())
+@doc(description='Get the list of all the built books that exist on the server. Accepts optional filter, field selection, pagination and format (format=ndjson streams one book per line) arguments passed in the request URL.', tags=['Book'])
+def api_get_books(user_name=None, repo_name=None, provider_name=None, since=None, until=None, include=None, exclude=None, cursor=None, limit=None, format=None):
+    # Catalog state only changes when a book is ingested, answer 
+    # conditional requests (e.g., roboneuro polls) before any query.
+    generation, last_modified = catalog_state()
+    etag = hashlib.md5(f"{generation}:{request.query_string.decode()}".encode()).hexdigest()
+    last_modified = datetime.datetime.fromtimestamp(int(last_modified), datetime.timezone.utc)
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = make_response("", 304)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        return response
+
+    user_name = request.args.get("user_name", user_name)
+    repo_name = request.args.get("repo_name", repo_name)
+    provider_name = request.args.get("provider_name", provider_name)
+    include = request.args.get("include", include)
+    exclude = request.args.get("exclude", exclude)
+    cursor = request.args.get("cursor", cursor)
+    format = request.args.get("format", format)
+    try:
+        limit = request.args.get("limit", limit, type=int)
+        if limit is not None and limit < 1:
+            raise ValueError("limit must be a positive integer.")
+        params = dict(user_name=user_name,
+                      repo_name=repo_name,
+                      provider_name=provider_name,
+                      since=parse_book_date(request.args.get("since", since)),
+                      until=parse_book_date(request.args.get("until", until)),
+                      cursor=cursor,
+                      limit=limit)
+        if format == "ndjson":
+            # Validate the arguments before the stream starts.
+            catalog_select(**params)
+        else:
+            books, next_cursor = book_page(**params)
+    except ValueError as e:
+        return make_response(jsonify(f"Bad request, {str(e)}"), 400)
+
+    include = include.split(",") if include else None
+    exclude = exclude.split(",") if exclude else None
+
+    if format == "ndjson":
+        # One book per line, straight from the catalog cursor. Neither the
+        # list nor the JSON string of all the books is ever materialized.
+        def generate():
+            for book in catalog_iter(**params):
+                if include or exclude:
+                    book = json.loads(book)
+                    if include:
+                        book = {key: book[key] for key in include if key in book}
+                    if exclude:
+                        book = {key: value for key, value in book.items() if key not in exclude}
+                    book = json.dumps(book)
+                yield book + "\n"
+        response = Response(generate(), mimetype='application/x-ndjson')
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        return response
+
+    if include:
+        books = [{key: book[key] for key in include if key in book} for book in books]
+    if exclude:
+        books = [{key: value for key, value in book.items() if key not in exclude} for book in books]
+
     if books:
-        return make_response(jsonify(books), 200)
+        response = make_response(jsonify(books), 200)
+        if next_cursor:
+            args = request.args.to_dict()
+            args["cursor"] = next_cursor
+            response.headers["X-Next-Cursor"] = next_cursor
+            response.headers["Link"] = f'<{request.base_url}?{urlencode(args)}>; rel="next"'
     else:
-        return make_response(jsonify("There are no books on this server yet."), 404)
+        response = make_response(jsonify("There are no books on this server yet."), 404)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return response
 
 @common_api.route('/api/book', methods=['GET'])
 @marshal_with(None,code=400,description="Bad request.")
 @marshal_with(None,code=404,description="Not found.")
 @marshal_with(None,code=200,description="Returns a JSON (possibly array) that contains information about the reproducible preprint (e.g. book_url).")
 @use_kwargs(BookSchema())
-@doc(description='Request an individual book url via commit, repo name or user name. Accepts arguments passed in the request URL.', tags=['Book'])
-def api_get_book(user_name=None,commit_hash=None,repo_name=None):
+@doc(description='Request an individual book url via commit (or a unique commit prefix), repo name, user name, provider or any combination of them. Accepts arguments passed in the request URL.', tags=['Book'])
+def api_get_book(user_name=None,commit_hash=None,repo_name=None,provider_name=None):
     
-    if  not any([user_name, commit_hash, repo_name]):
+    if  not any([user_name, commit_hash, repo_name, provider_name]):
         # Example debug message from within the blueprint route
         current_app.logger.debug('No payload, parsing request arguments.')
 
-    if "user_name" in request.args:
-        user_name = request.args.get("user_name")
-    elif "commit_hash" in request.args:
-        commit_hash = request.args.get("commit_hash")
-    elif "repo_name" in request.args:
-        repo_name = request.args.get("repo_name")
-    else:
-        response = make_response(jsonify('Bad request, no arguments passed to locate a book.'),400)
+    user_name = request.args.get("user_name", user_name)
+    commit_hash = request.args.get("commit_hash", commit_hash)
+    repo_name = request.args.get("repo_name", repo_name)
+    provider_name = request.args.get("provider_name", provider_name)
 
-    # Create an empty list for our results
-    results = book_get_by_params(user_name, commit_hash, repo_name)
+    if not any([user_name, commit_hash, repo_name, provider_name]):
+        return make_response(jsonify('Bad request, no arguments passed to locate a book.'),400)
+
+    # Books matching all the arguments passed.
+    try:
+        results = book_get_by_params(user_name, commit_hash, repo_name, provider_name)
+    except ValueError as e:
+        # Short commit hash is ambiguous or too short.
+        return make_response(jsonify(f"Bad request, {str(e)}"),400)
     
     if not results:
         response = make_response(jsonify('Requested book does not exist.'),404)
@@ -96,12 +182,44 @@ def api_get_book(user_name=None,commit_hash=None,repo_name=None):
 @doc(description='Remove the build lock that prevents recurrent or simultaneous build requests (rate limit 30 mins).', tags=['Book'])
 @use_kwargs(UnlockSchema())
 def api_unlock_build(user, repo_url):
-    lock_filename = get_lock_filename(repo_url)
-    if os.path.isfile(lock_filename):
-        os.remove(lock_filename)
+    try:
+        removed = build_lock_remove(repo_url)
+    except redis.RedisError as e:
+        return make_response(jsonify(f"Build locks are not available: {str(e)}"),503)
+    if removed:
         response = make_response(f"Removed the lock for {repo_url}",200)
     else:
         response =  make_response(f"No build lock found for {repo_url}",404)
     
     response.mimetype = "text/plain"
-    return response
\ No newline at end of file
+    return response
+
+@common_api.route('/api/book/lock', methods=['GET'])
+@require_http_auth
+@marshal_with(None,code=400,description="Bad request, repo_url is missing.")
+@marshal_with(None,code=200,description="Returns a JSON with the owner (e.g., task ID) and the remaining time (minutes) of the build lock.")
+@marshal_with(None,code=404,description="Lock does not exist.")
+@doc(description='Get the status of the build lock of a repository.', tags=['Book'])
+@use_kwargs(UnlockSchema())
+def api_build_lock_status(user, repo_url=None):
+    repo_url = request.args.get("repo_url", repo_url)
+    if not repo_url:
+        return make_response(jsonify('Bad request, repo_url is missing.'),400)
+    try:
+        lock_status = build_lock_status(repo_url)
+    except redis.RedisError as e:
+        return make_response(jsonify(f"Build locks are not available: {str(e)}"),503)
+    if lock_status is None:
+        return make_response(jsonify(f"No build lock found for {repo_url}"),404)
+    return make_response(jsonify(lock_status),200)
+
+@common_api.route('/api/github/budget', methods=['GET'])
+@require_http_auth
+@marshal_with(None,code=200,description="Remaining GitHub API quota per token and requests spent per task type.")
+@doc(description='Get the remaining GitHub API quota of the bot tokens and the number of requests spent (calls), answered with 304 Not Modified (not_modified) and deferred due to a low quota (deferred) per task type.', tags=['Tasks'])
+def api_github_budget(user):
+    try:
+        report = gh_budget_report()
+    except redis.RedisError as e:
+        return make_response(jsonify(f"GitHub budget is not available: {str(e)}"),503)
+    return make_response(jsonify(report),200)
@@ -0,0 +1,58 @@
+"""
+Live events of the book builds of the preview server (see
+build_events.py).
+
+A watcher follows a build for as long as it lasts, which would
+hold a sync gunicorn worker of the API for the whole build. This
+blueprint is served on its own by wsgi_events.py, with gevent
+workers (see neurolibre-events.service) so that a watcher costs
+a greenlet, and nginx sends the /api/book/build/<task_id>/events
+requests there.
+
+The preview API registers the blueprint as well, for the
+documentation.
+"""
+import functools
+import redis
+from flask import Response, Blueprint, current_app, jsonify, make_response, request, stream_with_context
+from flask_apispec import doc, marshal_with
+from flask_htpasswd import HtPasswdAuth
+from celery import states
+from neurolibre_celery_tasks import celery_app
+from build_events import build_events_sse, build_events_exist, build_events_ended, valid_event_id
+
+events_api = Blueprint('events_api', __name__)
+
+@events_api.before_app_first_request
+def setup_htpasswd_auth():
+    events_api.htpasswd_auth = HtPasswdAuth(current_app)
+
+def require_http_auth(view_func):
+    @functools.wraps(view_func)
+    def wrapper(*args, **kwargs):
+        return events_api.htpasswd_auth.required(view_func)(*args, **kwargs)
+    return wrapper
+
+@events_api.route('/api/book/build/<task_id>/events', methods=['GET'])
+@require_http_auth
+@marshal_with(None,code=400,description="Invalid Last-Event-ID.")
+@marshal_with(None,code=404,description="The task has finished and its events are no longer available.")
+@marshal_with(None,code=204,description="All the events of the build have been received.")
+@marshal_with(None,code=200,description="text/event-stream of the BinderHub build events, followed by an end event. Reconnect with Last-Event-ID to resume.")
+@doc(description='Follow the live events of a book build task, any number of clients can watch the same build.', tags=['Book'])
+def api_book_build_events(user, task_id):
+    last_event_id = request.headers.get("Last-Event-ID", request.args.get("last_event_id"))
+    if last_event_id and not valid_event_id(last_event_id):
+        return make_response(jsonify('Bad request, Last-Event-ID is not a valid event id.'),400)
+    try:
+        if last_event_id and build_events_ended(task_id, last_event_id):
+            # Tells EventSource clients to stop reconnecting.
+            return make_response("",204)
+        if not build_events_exist(task_id) and celery_app.AsyncResult(task_id).state in states.READY_STATES:
+            return make_response(jsonify('Requested build events do not exist.'),404)
+    except redis.RedisError as e:
+        return make_response(jsonify(f"Build events are not available: {str(e)}"),503)
+    response = Response(stream_with_context(build_events_sse(task_id, last_event_id)), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
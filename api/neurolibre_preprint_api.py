@@ -9,10 +9,12 @@ import shutil
 import git
 import logging
 import neurolibre_common_api
+import neurolibre_binder_api
 from common import *
 from preprint import *
 from github_client import *
-from schema import BinderSchema, BucketsSchema, UploadSchema, ListSchema, DeleteSchema, PublishSchema, DatasyncSchema, BooksyncSchema, ProdStartSchema, IDSchema
+from storage import book_dir, data_dir, doi_dir, deposit_dir
+from schema import BucketsSchema, UploadSchema, ListSchema, DeleteSchema, PublishSchema, DatasyncSchema, BooksyncSchema, ProdStartSchema, IDSchema
 from flask import jsonify, make_response, Config
 from flask_apispec import FlaskApiSpec, marshal_with, doc, use_kwargs
 from apispec import APISpec
@@ -36,6 +38,8 @@ app = flask.Flask(__name__)
 app.config.from_pyfile('preprint_config.py')
 
 app.register_blueprint(neurolibre_common_api.common_api)
+# Served by the gevent workers of wsgi_binder.py behind nginx.
+app.register_blueprint(neurolibre_binder_api.binder_api)
 
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
 
@@ -91,14 +95,15 @@ docs.register(neurolibre_common_api.api_get_book,blueprint="common_api")
 docs.register(neurolibre_common_api.api_get_books,blueprint="common_api")
 docs.register(neurolibre_common_api.api_heartbeat,blueprint="common_api")
 docs.register(neurolibre_common_api.api_unlock_build,blueprint="common_api")
+docs.register(neurolibre_common_api.api_build_lock_status,blueprint="common_api")
+docs.register(neurolibre_common_api.api_github_budget,blueprint="common_api")
+docs.register(neurolibre_binder_api.api_binder_build,blueprint="binder_api")
 
 """
 Configuration END
 """
 
-# Create a build_locks folder to control rate limits
-if not os.path.exists(os.path.join(os.getcwd(),'build_locks')):
-    os.makedirs(os.path.join(os.getcwd(),'build_locks'))
+# Build locks (rate limits) are kept in Redis, see build_locks.py
 
 
 """
@@ -110,8 +115,7 @@ API Endpoints START
 @doc(description='Copy summary PDF from neurolibre/preprints to NeuroLibre server.', tags=['Production'])
 @use_kwargs(IDSchema())
 def summary_pdf_sync_post(user,id):
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = gh_get_client()
     issue_id = id
     url_branch = f"https://raw.githubusercontent.com/neurolibre/preprints/neurolibre.{issue_id:05d}/neurolibre.{issue_id:05d}/10.55458.neurolibre.{issue_id:05d}.pdf"
     url_master = f"https://raw.githubusercontent.com/neurolibre/preprints/master/neurolibre.{issue_id:05d}/10.55458.neurolibre.{issue_id:05d}.pdf"
@@ -127,7 +131,7 @@ def summary_pdf_sync_post(user,id):
         return result 
     
     # PDF pool
-    file_path = os.path.join("/DATA","10.55458",f"neurolibre.{issue_id:05d}.pdf")
+    file_path = os.path.join(doi_dir(),f"neurolibre.{issue_id:05d}.pdf")
     response = requests.get(download_url)
 
     if response.status_code == 200:
@@ -151,8 +155,7 @@ docs.register(summary_pdf_sync_post)
 @doc(description='Upload the repository to the respective zenodo deposit.', tags=['Zenodo'])
 @use_kwargs(DatasyncSchema())
 def zenodo_upload_repository_post(user,id,repository_url):
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = gh_get_client()
     issue_id = id
 
     fname = f"zenodo_deposit_NeuroLibre_{issue_id:05d}.json"
@@ -191,8 +194,7 @@ docs.register(zenodo_upload_repository_post)
 @doc(description='Upload the built book to the respective zenodo deposit.', tags=['Zenodo'])
 @use_kwargs(DatasyncSchema())
 def zenodo_upload_book_post(user,id,repository_url):
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = gh_get_client()
     issue_id = id
 
     fname = f"zenodo_deposit_NeuroLibre_{issue_id:05d}.json"
@@ -231,8 +233,7 @@ docs.register(zenodo_upload_book_post)
 @doc(description='Upload the docker image to the respective zenodo deposit.', tags=['Zenodo'])
 @use_kwargs(DatasyncSchema())
 def zenodo_upload_docker_post(user,id,repository_url):
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = gh_get_client()
     issue_id = id
 
     fname = f"zenodo_deposit_NeuroLibre_{issue_id:05d}.json"
@@ -271,8 +272,7 @@ docs.register(zenodo_upload_docker_post)
 @doc(description='Get zenodo status for a submission.', tags=['Zenodo'])
 @use_kwargs(IDSchema())
 def api_zenodo_status(user,id):
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = gh_get_client()
     status_msg = zenodo_get_status(id)
     response = gh_create_comment(github_client,reviewRepository,id,status_msg)
     if response:
@@ -288,8 +288,7 @@ def api_zenodo_status(user,id):
 @use_kwargs(DatasyncSchema())
 def api_zenodo_publish(user,id,repository_url):
 
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = gh_get_client()
     issue_id = id
 
     task_title = "Publish Reproducibility Assets"
@@ -324,8 +323,7 @@ docs.register(api_zenodo_status)
 @use_kwargs(BucketsSchema())
 def api_zenodo_post(user,id,repository_url):
 
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = gh_get_client()
     issue_id = id
 
     data_archive_exists = gh_read_from_issue_body(github_client,reviewRepository,issue_id,"data-archive")
@@ -375,7 +373,7 @@ docs.register(api_zenodo_post)
 @marshal_with(None,code=422,description="Cannot validate the payload, missing or invalid entries.")
 @doc(description='Upload an item to the respective zenodo bucket (book, repository, data or docker image).', tags=['Zenodo'])
 @use_kwargs(UploadSchema())
-def api_upload_post(user,issue_id,repository_address,item,item_arg,fork_url,commit_fork):
+def api_upload_post(user,issue_id,repository_address,item,item_arg,fork_url,commit_fork=None):
     """
     Uploads one item at a time (book, repository, data or docker image) to zenodo 
     for the buckets that have been created.
@@ -385,6 +383,11 @@ def api_upload_post(user,issue_id,repository_address,item,item_arg,fork_url,comm
     fork_provider = fork_url.split("/")[-3]
     if not ((fork_provider == "github.com") | (fork_provider == "gitlab.com")):
         flask.abort(400)
+    # Archives are named for the commit pinned in the deposit record,
+    # like the ones uploaded by the Celery tasks.
+    commit_fork = get_deposit_commit(issue_id) or commit_fork
+    if not commit_fork:
+        flask.abort(400, "The deposit record does not pin a commit, commit_fork is required.")
     def run():
         ZENODO_TOKEN = os.getenv('ZENODO_API')
         params = {'access_token': ZENODO_TOKEN}
@@ -397,7 +400,7 @@ def api_upload_post(user,issue_id,repository_address,item,item_arg,fork_url,comm
         bucket_url = zenodo_record[item]['links']['bucket']
         if item == "book":
            # We will archive the book created through the forked repository.
-           local_path = os.path.join("/DATA", "book-artifacts", fork_repo, fork_provider, repofork, commit_fork, "_build", "html")
+           local_path = os.path.join(book_dir(fork_repo, fork_provider, repofork, commit_fork), "_build", "html")
            # Descriptive file name
            zenodo_file = os.path.join(get_archive_dir(issue_id),f"JupyterBook_10.55458_NeuroLibre_{'%05d'%issue_id}_{commit_fork[0:6]}")
            # Zip it!
@@ -546,8 +549,8 @@ def api_upload_post(user,issue_id,repository_address,item,item_arg,fork_url,comm
             zpath = expect
            else:
             # We will archive the data synced from the test server. (item_arg is the project_name, indicating that the 
-            # data is stored at the /DATA/project_name folder)
-            local_path = os.path.join("/DATA", item_arg)
+            # data is stored at the DATA_ROOT/project_name folder)
+            local_path = data_dir(item_arg)
             # Descriptive file name
             zenodo_file = os.path.join(get_archive_dir(issue_id),f"Dataset_10.55458_NeuroLibre_{'%05d'%issue_id}_{commit_fork[0:6]}")
             # Zip it!
@@ -589,7 +592,7 @@ def api_zenodo_list_post(user,issue_id):
     List zenodo records for a given technical screening ID.
     """
     def run():
-        path = f"/DATA/zenodo_records/{'%05d'%issue_id}"
+        path = deposit_dir(issue_id)
         if not os.path.exists(path):
             yield "<br> :neutral_face: I could not find any Zenodo-related records on NeuroLibre servers. Maybe start with `roboneuro zenodo deposit`?"
         else:
@@ -621,6 +624,10 @@ def api_zenodo_flush_post(user,issue_id,items):
         fname = f"zenodo_deposit_NeuroLibre_{'%05d'%issue_id}.json"
         local_file = os.path.join(get_deposit_dir(issue_id), fname)
         dat2recmap = {"data":"Dataset","repository":"GitHubRepo","docker":"DockerImage","book":"JupyterBook"}
+        # Archives of the pinned commit (any for older records),
+        # read before the items are removed from the record.
+        commit_fork = get_deposit_commit(issue_id)
+        commit_suffix = commit_fork[0:6] if commit_fork else "*"
         
         with open(local_file, 'r') as f:
             zenodo_record = json.load(f)
@@ -635,13 +642,13 @@ def api_zenodo_flush_post(user,issue_id,items):
                 # We need to delete these from the Zenodo records file
                 if item in zenodo_record: del zenodo_record[item]
                 # Flush ALL the upload records (json) associated with the item
-                tmp_record = glob.glob(os.path.join(get_deposit_dir(issue_id),f"zenodo_uploaded_{item}_NeuroLibre_{'%05d'%issue_id}_*.json"))
+                tmp_record = glob.glob(os.path.join(get_deposit_dir(issue_id),f"zenodo_uploaded_{item}_NeuroLibre_{'%05d'%issue_id}_{commit_suffix}.json"))
                 if tmp_record:
                     for f in tmp_record:
                         os.remove(f)
                         yield f"\n Deleted {f} record from the server."
                 # Flush ALL the uploaded files associated with the item
-                tmp_file = glob.glob(os.path.join(get_archive_dir(issue_id),f"{dat2recmap[item]}_10.55458_NeuroLibre_{'%05d'%issue_id}_*.zip"))
+                tmp_file = glob.glob(os.path.join(get_archive_dir(issue_id),f"{dat2recmap[item]}_10.55458_NeuroLibre_{'%05d'%issue_id}_{commit_suffix}.zip"))
                 if tmp_file:
                     for f in tmp_file:
                         os.remove(f)
@@ -676,8 +683,7 @@ docs.register(api_zenodo_flush_post)
 def api_data_sync_post(user,id,repository_url):
     # Create a comment in the review issue. 
     # The worker will update that depending on the  state of the task.
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = gh_get_client()
     issue_id = id
     #app.logger.debug(f'{issue_id} {repository_url}')
     project_name = gh_get_project_name(github_client,repository_url)
@@ -716,8 +722,7 @@ def api_books_sync_post(user,id,repository_url,commit_hash="HEAD"):
     server = f"https://{serverName}.{serverDomain}"
     # TODO: Implement this into a class not to 
     # repeat this, make sure that async call friendly
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = gh_get_client()
     # Task name
     task_title = "REPRODUCIBLE PREPRINT TRANSFER (Preview --> Preprint)"
     # Make comment under the issue
@@ -746,8 +751,7 @@ docs.register(api_books_sync_post)
 def api_production_start_post(user,id,repository_url,commit_hash="HEAD"):
     issue_id = id
     repo_url = repository_url
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = gh_get_client()
     task_title = "INITIATE PRODUCTION (Fork and Configure)"
     comment_id = gh_template_respond(github_client,"pending",task_title,reviewRepository,issue_id)
     # Start BG process
@@ -764,61 +768,6 @@ def api_production_start_post(user,id,repository_url,commit_hash="HEAD"):
 
 docs.register(api_production_start_post)
 
-# This is named as a binder/build instead of /book/build due to its context 
-# Production server BinderHub deployment does not build a book.
-@app.route('/api/binder/build', methods=['POST'])
-@htpasswd.required
-@doc(description='Request a binderhub build on the production server for a given repo and hash. Repository must belong to the roboneurolibre organization.', tags=['Binder'])
-@use_kwargs(BinderSchema())
-def api_binder_build(user,repo_url, commit_hash):
-
-    binderhub_request = run_binder_build_preflight_checks(repo_url,commit_hash,build_rate_limit, binderName, domainName)
-
-    # Request build from the preview binderhub instance
-    app.logger.info(f"Starting BinderHub request at {binderhub_request } ...")
-
-    lock_filename = get_lock_filename(repo_url)
-
-    response = requests.get(binderhub_request, stream=True)
-    if response.ok:
-        # Forward the response as an event stream
-        def generate():
-            for line in response.iter_lines():
-                if line:
-                    # Fetch streamed block
-                    event_string = line.decode("utf-8")
-                    try:
-                        # Try getting an event object if the emit message
-                        # is json (e.g., may be keepalive otherwise)
-                        event = json.loads(event_string.split(': ', 1)[1])
-
-                        # https://binderhub.readthedocs.io/en/latest/api.html
-                        # MUST close response when phase is failed
-                        if event.get('phase') == 'failed':
-                            response.close()
-                            # Remove the lock as binder build failed.
-                            app.logger.info(f"[FAILED] BinderHub build {binderhub_request}.")
-                            os.remove(lock_filename)
-                            return
-
-                        message = event.get('message')
-                        if message:
-                            # Only print when phase emits a message to
-                            # keep the logs neat.
-                            yield message
-                    # An exception to handle 
-                    # for Gunicorn asynchronous worker (gevent)
-                    except GeneratorExit:
-                        pass
-                    except:
-                        # Pass other events
-                        pass
-
-    os.remove(lock_filename)
-    return flask.Response(generate(), mimetype='text/event-stream')
-
-# Register endpoint to the documentation
-docs.register(api_binder_build)
 
 @app.route('/api/test', methods=['GET'])
 @htpasswd.required
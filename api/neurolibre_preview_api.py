@@ -5,10 +5,14 @@ import time
 import requests
 import git
 import logging
+import redis
 import neurolibre_common_api
-from flask import jsonify, make_response
+import neurolibre_events_api
+from flask import jsonify, make_response, request
 from common import *
-from schema import BuildSchema, BuildTestSchema
+from schema import BuildSchema, BuildTestSchema, RegistrySchema
+from build_registry import registry_lookup
+from build_locks import build_inflight_task, build_inflight_join, build_inflight_finish
 from flask_htpasswd import HtPasswdAuth
 from dotenv import load_dotenv
 from werkzeug.middleware.proxy_fix import ProxyFix
@@ -18,6 +22,8 @@ from apispec.ext.marshmallow import MarshmallowPlugin
 from github_client import *
 from neurolibre_celery_tasks import celery_app, sleep_task, preview_build_book_task, preview_build_book_test_task
 from celery.events.state import State
+from celery import states
+from celery.utils import uuid
 from github import Github, UnknownObjectException
 
 """
@@ -33,6 +39,8 @@ app = flask.Flask(__name__)
 app.config.from_pyfile('preview_config.py')
 
 app.register_blueprint(neurolibre_common_api.common_api)
+# Served by wsgi_events.py (gevent), registered for the documentation.
+app.register_blueprint(neurolibre_events_api.events_api)
 
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
 
@@ -84,14 +92,15 @@ docs.register(neurolibre_common_api.api_get_book,blueprint="common_api")
 docs.register(neurolibre_common_api.api_get_books,blueprint="common_api")
 docs.register(neurolibre_common_api.api_heartbeat,blueprint="common_api")
 docs.register(neurolibre_common_api.api_unlock_build,blueprint="common_api")
+docs.register(neurolibre_common_api.api_build_lock_status,blueprint="common_api")
+docs.register(neurolibre_common_api.api_github_budget,blueprint="common_api")
+docs.register(neurolibre_events_api.api_book_build_events,blueprint="events_api")
 
 """
 Configuration END
 """
 
-# Create a build_locks folder to control rate limits
-if not os.path.exists(os.path.join(os.getcwd(),'build_locks')):
-    os.makedirs(os.path.join(os.getcwd(),'build_locks'))
+# Build locks (rate limits) are kept in Redis, see build_locks.py
 
 """
 API Endpoints START
@@ -101,22 +110,54 @@ API Endpoints START
 @app.route('/api/book/build', methods=['POST'])
 @htpasswd.required
 @marshal_with(None,code=422,description="Cannot validate the payload, missing or invalid entries.")
-@marshal_with(None,code=200,description="Accept text/eventstream for BinderHub build logs. Keepalive 30s.")
+@marshal_with(None,code=200,description="The build task has been started, or the request has been attached to the build of the same commit in progress. Returns the book if it has already been built at this commit (unless force).")
 @doc(description='Endpoint for building reproducibility assets on the preview BinderHub instance: Repo2Data, (Binder) Repo2Docker, Jupyter Book.', tags=['Book'])
 @use_kwargs(BuildSchema())
-def api_book_build(user, id, repo_url, commit_hash):
+def api_book_build(user, id, repo_url, commit_hash, force=False):
     """
-    Connect to binderhub build eventstream and forward it to 
-    the client.
-    TODO: Celery.
+    Start a book build task, unless the book has already been
+    built at this commit (returned as is) or is being built
+    (the request gets the outcome of that build).
     """
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = gh_get_client()
     issue_id = id
 
     task_title = "Book Build (Preview)"
     comment_id = gh_template_respond(github_client,"pending",task_title,reviewRepository,issue_id)
 
+    # Same commit for the lookups below and the build.
+    commit_hash = format_commit_hash(repo_url, commit_hash)
+    [owner, repo, provider] = get_owner_repo_provider(repo_url)
+
+    if not force:
+        try:
+            book = book_get_by_params(user_name=owner, repo_name=repo, commit_hash=commit_hash)
+        except ValueError as e:
+            # Short commit hash is ambiguous or too short.
+            gh_template_respond(github_client,"failure",task_title,reviewRepository,issue_id,"",comment_id, f"Bad request, {str(e)}")
+            return make_response(jsonify(f"Bad request, {str(e)}"),400)
+        if book:
+            gh_template_respond(github_client,"exists",task_title,reviewRepository,issue_id,"",comment_id, f"The book has already been built at {commit_hash}: {book[0]['book_url']}")
+            return make_response(jsonify(book[0]),200)
+
+    # The task id is known before the task is started, so
+    # that the build can be claimed for it atomically.
+    task_id = uuid()
+    watcher = dict(issue_id=issue_id, comment_id=comment_id, review_repository=reviewRepository)
+    try:
+        inflight_task_id = build_inflight_task(repo_url, commit_hash)
+        if inflight_task_id and celery_app.AsyncResult(inflight_task_id).state in states.READY_STATES:
+            # The task ended without finishing the build (e.g., killed).
+            build_inflight_finish(repo_url, commit_hash, inflight_task_id)
+        build_task_id, claimed = build_inflight_join(repo_url, commit_hash, task_id, watcher)
+    except redis.RedisError as e:
+        app.logger.warning(f"Builds in flight are not available: {str(e)}")
+        build_task_id, claimed = task_id, True
+
+    if not claimed:
+        gh_template_respond(github_client,"received",task_title,reviewRepository,issue_id,build_task_id,comment_id, f"A build of {commit_hash} is already in progress, this comment will be updated with its outcome.")
+        return make_response(jsonify(f"Attached to the build in progress: {build_task_id}"),200)
+
     celery_payload = dict(repo_url=repo_url, 
                           commit_hash=commit_hash, 
                           rate_limit=build_rate_limit,
@@ -127,13 +168,14 @@ def api_book_build(user, id, repo_url, commit_hash):
                           review_repository=reviewRepository,
                           task_title=task_title)
     
-    task_result = preview_build_book_task.apply_async(args=[celery_payload])
+    task_result = preview_build_book_task.apply_async(args=[celery_payload], task_id=task_id)
 
     if task_result.task_id is not None:
         gh_template_respond(github_client,"received",task_title,reviewRepository,issue_id,task_result.task_id,comment_id, "")
         response = make_response(jsonify("Celery task assigned successfully."),200)
     else:
         # If not successfully assigned, fail the status immediately and return 500
+        build_inflight_finish(repo_url, commit_hash, task_id)
         gh_template_respond(github_client,"failure",task_title,reviewRepository,issue_id,task_result.task_id,comment_id, "Internal server error: NeuroLibre background task manager could not receive the request.")
         response = make_response(jsonify("Celery could not start the task."),500)
     return response
@@ -252,6 +294,31 @@ def api_book_build_test(user, repo_url, commit_hash, email):
 
 docs.register(api_book_build_test)
 
+@app.route('/api/registry/build', methods=['GET'])
+@htpasswd.required
+@marshal_with(None,code=400,description="Bad request.")
+@marshal_with(None,code=404,description="No build matches the arguments.")
+@marshal_with(None,code=200,description="Returns a JSON that contains the build (date, repository_url, commit_hash, docker_image, project_name, data_url, data_doi, status).")
+@use_kwargs(RegistrySchema())
+@doc(description='Look up the latest successful build of a repository, commit, docker image or any combination of them in the build registry.', tags=['Book'])
+def api_registry_build(user, repository_url=None, commit_hash=None, docker_image=None, status=None):
+    repository_url = request.args.get("repository_url", repository_url)
+    commit_hash = request.args.get("commit_hash", commit_hash)
+    docker_image = request.args.get("docker_image", docker_image)
+    status = request.args.get("status", status or "success")
+    if not any([repository_url, commit_hash, docker_image]):
+        return make_response(jsonify('Bad request, no arguments passed to locate a build.'),400)
+    if status not in ["success", "failure", "any"]:
+        return make_response(jsonify('Bad request, status should be success, failure or any.'),400)
+    build = registry_lookup(repository_url, commit_hash, docker_image, None if status == "any" else status)
+    if build is None:
+        response = make_response(jsonify('Requested build does not exist.'),404)
+    else:
+        response = make_response(jsonify(build),200)
+    return response
+
+docs.register(api_registry_build)
+
 @app.route('/api/test', methods=['GET'])
 @htpasswd.required
 @doc(description='Check if SSL verified authentication is functional.', tags=['Test'])
@@ -5,18 +5,31 @@ from common import *
 from dotenv import load_dotenv
 import re
 from github import Github
-from github_client import gh_read_from_issue_body 
+from github_client import gh_get_client, gh_read_from_issue_body
 import csv
+import glob
 import subprocess
+import logging
+from storage import archive_dir, deposit_dir, data_path
+from build_registry import LOOKUP_TABLE_KEYS, normalize_repository_url, commit_from_image
 
 load_dotenv()
 
+# Key of the pinned fork commit in each item of the deposit record.
+DEPOSIT_COMMIT_KEY = "neurolibre_commit_fork"
+
 """
 Helper functions for the tasks 
 performed by the preprint (production server).
 """
 
-def zenodo_create_bucket(title, archive_type, creators, repository_url, issue_id):
+def zenodo_create_bucket(title, archive_type, creators, repository_url, issue_id, commit_user="HEAD", commit_fork="HEAD"):
+    """
+    Create the Zenodo deposit (bucket) of an archive type. Pass the
+    commits of the author's repository and of the fork when they are
+    already resolved (e.g., once for all the archive types), HEAD
+    is resolved otherwise.
+    """
     
     [owner,repo,provider] =  get_owner_repo_provider(repository_url,provider_full_name=True)
 
@@ -34,8 +47,8 @@ def zenodo_create_bucket(title, archive_type, creators, repository_url, issue_id
     # book build. That may not be the case. Requires better 
     # data handling or extra functionality to retreive the latest successful
     # book commit.
-    commit_user = format_commit_hash(repository_url,"HEAD")
-    commit_fork = format_commit_hash(fork_url,"HEAD")
+    commit_user = format_commit_hash(repository_url,commit_user,cached=True)
+    commit_fork = format_commit_hash(fork_url,commit_fork,cached=True)
 
     libre_text = f"<a href=\"{fork_url}/commit/{commit_fork}\"> reference repository/commit by roboneuro</a>"
     user_text = f"<a href=\"{repository_url}/commit/{commit_user}\">latest change by the author</a>"
@@ -165,13 +178,13 @@ def docker_save(image,issue_id,commit_fork):
     return {"status": status, "message": output}, save_name
 
 def get_archive_dir(issue_id):
-    path = f"/DATA/zenodo/{issue_id:05d}"
+    path = archive_dir(issue_id)
     if not os.path.exists(path):
         os.makedirs(path)
     return path
 
 def get_deposit_dir(issue_id):
-    path = f"/DATA/zenodo_records/{issue_id:05d}"
+    path = deposit_dir(issue_id)
     if not os.path.exists(path):
         os.makedirs(path)
     return path
@@ -179,7 +192,7 @@ def get_deposit_dir(issue_id):
 
 def zenodo_get_status(issue_id):
 
-    zenodo_dir = f"/DATA/zenodo_records/{issue_id:05d}"
+    zenodo_dir = deposit_dir(issue_id)
 
     # Create directory if does not exists.
     if not os.path.exists(zenodo_dir):
@@ -188,8 +201,7 @@ def zenodo_get_status(issue_id):
     file_list = [f for f in os.listdir(zenodo_dir) if os.path.isfile(os.path.join(zenodo_dir,f))]
     res = ','.join(file_list)
 
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = gh_get_client()
 
     data_archive_exists = gh_read_from_issue_body(github_client,"neurolibre/neurolibre-reviews",issue_id,"data-archive")
 
@@ -300,15 +312,12 @@ def zenodo_upload_item(upload_file,bucket_url,issue_id,commit_fork,item_name):
     return r
 
 
-def find_resource_idx(lst, repository_url):
-    """
-    Helper function for get_resource_lookup.
-    """
-    tmp = [index for index, item in enumerate(lst) if repository_url in item[0]]
-    if tmp:
-        return tmp[0]
-    else:
-        return None
+# Local copy of the preview server's lookup table and the
+# validators (ETag, Last-Modified) it was fetched with.
+LOOKUP_TABLE_CACHE = data_path("lookup_table.tsv")
+LOOKUP_TABLE_VALIDATORS = LOOKUP_TABLE_CACHE + ".headers.json"
+# Parsed once per local copy (keyed by its mtime).
+resource_lookup = {"mtime": None, "table": {}}
 
 def parse_tsv_content(content):
     """
@@ -317,7 +326,7 @@ def parse_tsv_content(content):
     # Create a CSV reader object
     reader = csv.reader(content.splitlines(), delimiter='\t')
     # Skip the header row
-    next(reader)
+    next(reader, None)
     # Create a list to store the parsed data
     parsed_data = []
     # Iterate over each row and add it to the parsed_data list
@@ -326,7 +335,107 @@ def parse_tsv_content(content):
     
     return parsed_data
 
-def get_resource_lookup(preview_server,verify_ssl,repository_address):
+def build_resource_table(parsed_data):
+    """
+    Helper function for get_resource_lookup. Returns a dict
+    of the lookup table entries keyed by normalized repository URL.
+    Rows are appended as builds succeed, the last row of a repository
+    (its latest build) wins, same as the build registry. Builds at a
+    given commit (from the image tag) are also keyed by (URL, commit).
+    """
+    table = {}
+    for row in parsed_data:
+        if not row:
+            continue
+        # The last two keys are not reliable (that may contain comma that is not separating tsv column)
+        # also due to subpar documentation issue with repo2data.
+        lut = dict(zip(LOOKUP_TABLE_KEYS, row[0].split(",")))
+        if lut.get("repository_url"):
+            repository_url = normalize_repository_url(lut["repository_url"])
+            table[repository_url] = lut
+            commit_hash = commit_from_image(lut.get("docker_image", ""))
+            if commit_hash:
+                table[(repository_url, commit_hash)] = lut
+    return table
+
+def fetch_lookup_table(preview_server,verify_ssl):
+    """
+    Helper function for get_resource_lookup. Refreshes the local copy
+    of the lookup table with a conditional request, so that the table
+    is transferred only when it changed on the preview server.
+    Keeps the local copy (if any) when the preview server cannot be reached.
+    """
+    url = f"{preview_server}/book-artifacts/lookup_table.tsv"
+    API_USER = os.getenv('TEST_API_USER')
+    API_PASS = os.getenv('TEST_API_PASS')
+    auth = (API_USER, API_PASS)
+
+    headers = {}
+    if os.path.exists(LOOKUP_TABLE_CACHE) and os.path.exists(LOOKUP_TABLE_VALIDATORS):
+        with open(LOOKUP_TABLE_VALIDATORS) as f:
+            validators = json.load(f)
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+    try:
+        response = requests.get(url, headers=headers, auth=auth, verify=verify_ssl, timeout=30)
+    except requests.RequestException as e:
+        logging.warning(f"Cannot fetch {url}: {str(e)}")
+        return
+    if response.status_code == 304:
+        return
+    if not response.ok:
+        logging.warning(f"Cannot fetch {url}: {response.status_code}")
+        return
+    # Replace atomically, other workers may be reading it.
+    tmp_file = f"{LOOKUP_TABLE_CACHE}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(response.content)
+    os.replace(tmp_file, LOOKUP_TABLE_CACHE)
+    tmp_file = f"{LOOKUP_TABLE_VALIDATORS}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump({"etag": response.headers.get("ETag"),
+                   "last_modified": response.headers.get("Last-Modified")}, f)
+    os.replace(tmp_file, LOOKUP_TABLE_VALIDATORS)
+
+def load_resource_table():
+    """
+    Helper function for get_resource_lookup. Parses the local
+    copy of the lookup table, once per version of the file.
+    """
+    if not os.path.exists(LOOKUP_TABLE_CACHE):
+        return {}
+    mtime = os.path.getmtime(LOOKUP_TABLE_CACHE)
+    if resource_lookup["mtime"] != mtime:
+        with open(LOOKUP_TABLE_CACHE, encoding="utf-8") as f:
+            resource_lookup["table"] = build_resource_table(parse_tsv_content(f.read()))
+        resource_lookup["mtime"] = mtime
+    return resource_lookup["table"]
+
+def query_build_registry(preview_server,verify_ssl,repository_address,commit_hash=None):
+    """
+    Helper function for get_resource_lookup. Returns the latest
+    successful build of a repository (at commit_hash if given) from
+    the build registry of the preview server (see build_registry.py),
+    None if there is no such build. Raises requests.RequestException
+    if the registry cannot be queried.
+    """
+    url = f"{preview_server}/api/registry/build"
+    API_USER = os.getenv('TEST_API_USER')
+    API_PASS = os.getenv('TEST_API_PASS')
+    auth = (API_USER, API_PASS)
+    params = {"repository_url": repository_address}
+    if commit_hash:
+        params["commit_hash"] = commit_hash
+    response = requests.get(url, params=params, auth=auth, verify=verify_ssl, timeout=30)
+    if response.status_code == 404 and response.headers.get("Content-Type", "").startswith("application/json"):
+        return None
+    response.raise_for_status()
+    return response.json()
+
+def get_resource_lookup(preview_server,verify_ssl,repository_address,commit_hash=None):
     """
     For a given repository address, returns a dictionary 
     that contains the following fields:
@@ -335,44 +444,23 @@ def get_resource_lookup(preview_server,verify_ssl,repository_address):
 
     Returns None otherwise.
 
-    The lookup_table.tsv exists on the preview server.
+    The build registry of the preview server is queried (exact match of
+    the repository URL, latest successful build). If it cannot be reached,
+    falls back to the lookup_table.tsv of the preview server, of which a
+    local copy is kept under the data root and refreshed only when it changed.
 
-    Ideally, this should be dealt with using a proper database instead of a tsv file.
+    If commit_hash is given, only a build of the repository at that commit
+    is returned. The lookup table has the commit in the image tag only
+    (see build_resource_table).
     """
-    
-    url = f"{preview_server}/book-artifacts/lookup_table.tsv"
-    headers = {'Content-Type': 'application/json'}
-    API_USER = os.getenv('TEST_API_USER')
-    API_PASS = os.getenv('TEST_API_PASS')
-    auth = (API_USER, API_PASS)
-
-    # Send GET request
-    response = requests.get(url, headers=headers, auth=auth, verify=verify_ssl)
-    
-    # Process response
-    if response.ok:
-        # Get content body
-        content = response.content.decode('utf-8')
-        # Parse content
-        parsed_data = parse_tsv_content(content)
-        # Get string that contains the repo_url
-        idx = find_resource_idx(parsed_data,repository_address)
-
-        if idx:
-            # Convert to list
-            values = parsed_data[idx][0].split(",")
-            # Convert to dict 
-            # The last two keys are not reliable (that may contain comma that is not separating tsv column)
-            # also due to subpar documentation issue with repo2data.
-            keys = ["date","repository_url","docker_image","project_name","data_url","data_doi"]
-            lut = dict(zip(keys, values))
-        else: 
-            lut = None
-    else:
-        
-        lut = None
-    
-    return lut
+    try:
+        return query_build_registry(preview_server,verify_ssl,repository_address,commit_hash)
+    except (requests.RequestException, ValueError) as e:
+        logging.warning(f"Build registry is not available, using the lookup table: {str(e)}")
+    fetch_lookup_table(preview_server,verify_ssl)
+    if commit_hash:
+        return load_resource_table().get((normalize_repository_url(repository_address), commit_hash))
+    return load_resource_table().get(normalize_repository_url(repository_address))
 
 def zenodo_publish(issue_id):
     ZENODO_TOKEN = os.getenv('ZENODO_API')
@@ -387,6 +475,9 @@ def zenodo_publish(issue_id):
 
     if upload_status[0]:
         zenodo_record = get_zenodo_deposit(issue_id)
+        commit_fork = get_deposit_commit(issue_id)
+        if commit_fork:
+            message.append(f"\n :pushpin: Archives of the fork at <code>{commit_fork}</code>.")
         # We need self links from each record to publish.
         for item in zenodo_record.keys():
             publish_link = zenodo_record[item]['links']['publish']
@@ -422,6 +513,9 @@ def zenodo_confirm_status(issue_id,status_type):
     if not zenodo_record:
         return [False,"no-record-found"]
     else:
+        # Uploads must be of the pinned commit (any for older records).
+        commit_fork = get_deposit_commit(issue_id)
+        commit_suffix = commit_fork[0:6] if commit_fork else "*"
         bool_array = []
         for item in zenodo_record.keys():
             if status_type == "published":
@@ -429,7 +523,7 @@ def zenodo_confirm_status(issue_id,status_type):
                 tmp = glob.glob(os.path.join(get_deposit_dir(issue_id),f"zenodo_{status_type}_{item}_NeuroLibre_{issue_id:05d}.json"))
             elif status_type == "uploaded":
                 # Appends commit hash
-                tmp = glob.glob(os.path.join(get_deposit_dir(issue_id),f"zenodo_{status_type}_{item}_NeuroLibre_{issue_id:05d}_*.json"))
+                tmp = glob.glob(os.path.join(get_deposit_dir(issue_id),f"zenodo_{status_type}_{item}_NeuroLibre_{issue_id:05d}_{commit_suffix}.json"))
 
             if tmp:
                 bool_array.append(True)
@@ -446,6 +540,25 @@ def zenodo_confirm_status(issue_id,status_type):
         elif not (all_true or all_false):
            return [False,"Some"]
 
+def get_deposit_commit(issue_id,fork_url=None):
+    """
+    Commit of the fork that the archives of a submission are created
+    for, pinned in the deposit record when the buckets are created
+    (see zenodo_create_buckets_task), so that all the archives refer
+    to the same commit even if the fork moves in the meantime.
+
+    For the records created before the commit was pinned, falls back
+    to the HEAD of fork_url if given, returns None otherwise.
+    """
+    zenodo_record = get_zenodo_deposit(issue_id)
+    if zenodo_record:
+        for item in zenodo_record.values():
+            if item.get(DEPOSIT_COMMIT_KEY):
+                return item[DEPOSIT_COMMIT_KEY]
+    if fork_url:
+        return format_commit_hash(fork_url,"HEAD",cached=True)
+    return None
+
 def get_zenodo_deposit(issue_id):
     fname = f"zenodo_deposit_NeuroLibre_{issue_id:05d}.json"
     local_file = os.path.join(get_deposit_dir(issue_id), fname)
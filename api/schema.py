@@ -16,8 +16,21 @@ class TaskSchema(Schema):
 
 class BookSchema(Schema):
     user_name = fields.String(required=False,description="Return NeuroLibre reproducible preperints that match a user (owner) name (suggested to be used in addition to the repo_name)")
-    commit_hash = fields.String(required=False,description="Return NeuroLibre reproducible preprints built at the requested commit hash.")
+    commit_hash = fields.String(required=False,description="Return NeuroLibre reproducible preprints built at the requested commit hash, or at the commit that uniquely starts with it (at least 4 characters).")
     repo_name = fields.String(required=False,description="Return NeuroLibre reproducible preprints for a repository name (suggested to be used in addition to the user_name).")
+    provider_name = fields.String(required=False,description="Return NeuroLibre reproducible preprints for a repository provider (e.g., github.com).")
+
+class BooksSchema(Schema):
+    user_name = fields.String(required=False,description="Only return the books of a user (owner) name.")
+    repo_name = fields.String(required=False,description="Only return the books of a repository name.")
+    provider_name = fields.String(required=False,description="Only return the books of a provider (e.g., github.com).")
+    since = fields.String(required=False,description="Only return the books added at or after this date (ISO 8601 or epoch seconds).")
+    until = fields.String(required=False,description="Only return the books added at or before this date (ISO 8601 or epoch seconds).")
+    include = fields.String(required=False,description="Comma separated list of the fields to return for each book (e.g., book_url,commit_hash).")
+    exclude = fields.String(required=False,description="Comma separated list of the fields to omit for each book (e.g., notebook_list).")
+    limit = fields.Integer(required=False,description="Maximum number of books to return (most recent first). All books are returned if not given.")
+    cursor = fields.String(required=False,description="Pagination cursor, as returned in the X-Next-Cursor header of the previous page.")
+    format = fields.String(required=False,description="Set to ndjson to stream the books as newline delimited JSON (one book per line) instead of a JSON array.")
 
 # Preview server
 
@@ -28,6 +41,7 @@ class BuildSchema(Schema):
     id = fields.Integer(required=True,description="Issue number of the technical screening of this preprint.")
     repo_url = fields.Str(required=True,description="Full URL of a NeuroLibre compatible repository to be used for building the book.")
     commit_hash = fields.String(required=True,dump_default="HEAD",description="Commit SHA to be checked out for building the book. Defaults to HEAD.")
+    force = fields.Boolean(required=False,load_default=False,description="Build the book even if it has already been built at this commit.")
 
 class BuildTestSchema(Schema):
     """
@@ -37,6 +51,15 @@ class BuildTestSchema(Schema):
     commit_hash = fields.String(required=True,dump_default="HEAD",description="Commit SHA to be checked out for building the book. Defaults to HEAD.")
     email = fields.Str(required=True,description="Email address to send the response.")
 
+class RegistrySchema(Schema):
+    """
+    Defines the arguments for looking up a build in the build registry.
+    """
+    repository_url = fields.Str(required=False,description="Full URL of the repository (exact match, e.g. https://github.com/roboneurolibre/repo).")
+    commit_hash = fields.String(required=False,description="Full commit SHA of the build.")
+    docker_image = fields.String(required=False,description="Docker image of the build.")
+    status = fields.String(required=False,dump_default="success",description="Build status (success or failure), set to any to return the latest build regardless of its status. Defaults to success.")
+
 # Preprint server
 
 class BinderSchema(Schema):
@@ -62,7 +85,7 @@ class UploadSchema(Schema):
     item = fields.String(required=True,description="One of the following: | book | repository | data | docker |")
     item_arg = fields.String(required=True,description="Additional information to locate the item on the server. Needed for items data and docker.")
     fork_url = fields.String(required=True,description="Full URL of the forked (roboneurolibre) repository.")
-    commit_fork = fields.String(required=True,description="Commit sha at which the forked repository (and other resources) will be deposited")
+    commit_fork = fields.String(required=False,description="Commit sha at which the forked repository (and other resources) will be deposited. Only for the deposit records that do not pin the commit (created before it was pinned), ignored otherwise.")
 
 class ListSchema(Schema):
     issue_id = fields.Int(required=True,description="Issue number of the technical screening of this preprint.")
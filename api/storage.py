@@ -0,0 +1,220 @@
+import os
+import glob
+import hashlib
+"""
+Where the artifacts of the respective server live on disk.
+
+Books can be spread over multiple volumes (storage roots)
+for I/O throughput. Every root has the same layout:
+
+    root/user/provider/repo/commit.tar.gz
+    root/user/provider/repo/commit/_build/...
+
+All the commits of a repository are placed on the same root,
+chosen either per provider or by hashing provider/user/repo.
+Books that already exist are found on whichever root they are,
+so that adding a root does not require moving existing books.
+
+Configuration (environment variables):
+
+    BOOK_ROOTS      Comma separated list of book roots (or BOOK_ROOT
+                    for a single one). Default /DATA/book-artifacts.
+    BOOK_SHARDING   hash (default) or provider.
+    BOOK_PROVIDER_ROOTS
+                    Comma separated provider=root pairs for the provider
+                    sharding, e.g. github.com=/DATA1/book-artifacts
+    BOOK_URL        Public URL that the book paths are served under.
+    NEUROLIBRE_DATA Root of the other artifacts (data, zenodo archives
+                    and records, DOI formatted books). Default /DATA.
+    PREVIEW_DATA    Same, on the preview server (rsync source).
+    PREVIEW_BOOK_ROOTS
+                    Comma separated list of the book roots of the
+                    preview server (rsync sources), default
+                    PREVIEW_DATA/book-artifacts.
+    BINDER_LOG_URL  Public URL that the BinderHub build logs
+                    (DATA_ROOT/binder_logs) are served under.
+
+URLs are the same regardless of the root a book is on, nginx
+looks the book up in every root (try_files, see nginx/*.conf).
+For that, every root is a directory named book-artifacts (e.g.,
+/DATA2/book-artifacts). The nginx configurations serve at most
+MAX_BOOK_ROOTS roots, /DATA/book-artifacts then /DATA2/book-artifacts
+(add a named location per extra root there before raising it).
+The configuration is validated on import.
+"""
+
+DATA_ROOT = os.getenv('NEUROLIBRE_DATA', "/DATA")
+BOOK_ROOTS = [root.rstrip("/") for root in
+              os.getenv('BOOK_ROOTS', os.getenv('BOOK_ROOT', f"{DATA_ROOT}/book-artifacts")).split(",") if root]
+BOOK_SHARDING = os.getenv('BOOK_SHARDING', "hash")
+BOOK_PROVIDER_ROOTS = {provider: root.rstrip("/") for provider, root in
+                       (pair.split("=", 1) for pair in os.getenv('BOOK_PROVIDER_ROOTS', "").split(",") if "=" in pair)}
+BOOK_URL = os.getenv('BOOK_URL', "https://preview.neurolibre.org/book-artifacts")
+PREVIEW_DATA_ROOT = os.getenv('PREVIEW_DATA', "/DATA")
+PREVIEW_BOOK_ROOTS = [root.rstrip("/") for root in
+                      os.getenv('PREVIEW_BOOK_ROOTS', f"{PREVIEW_DATA_ROOT}/book-artifacts").split(",") if root]
+BINDER_LOG_URL = os.getenv('BINDER_LOG_URL', "https://preview.neurolibre.org/binder-logs")
+# Kept for the single root deployments.
+BOOK_ROOT = BOOK_ROOTS[0] if BOOK_ROOTS else None
+# Roots served by nginx (see nginx/*.conf).
+MAX_BOOK_ROOTS = 2
+
+def validate_storage():
+    """
+    Raise ValueError if the book roots are not configured so that
+    every book can be placed and served.
+    """
+    if not BOOK_ROOTS:
+        raise ValueError("BOOK_ROOTS is empty.")
+    if len(BOOK_ROOTS) > MAX_BOOK_ROOTS:
+        raise ValueError(f"BOOK_ROOTS has {len(BOOK_ROOTS)} roots, nginx serves at most {MAX_BOOK_ROOTS}.")
+    if not PREVIEW_BOOK_ROOTS:
+        raise ValueError("PREVIEW_BOOK_ROOTS is empty.")
+    for root in BOOK_ROOTS:
+        if os.path.basename(root) != "book-artifacts":
+            raise ValueError(f"Book root {root} is not named book-artifacts, nginx cannot serve its books.")
+    if BOOK_SHARDING not in ["hash", "provider"]:
+        raise ValueError(f"BOOK_SHARDING should be hash or provider, not {BOOK_SHARDING}.")
+    for provider, root in BOOK_PROVIDER_ROOTS.items():
+        if root not in BOOK_ROOTS:
+            raise ValueError(f"Book root {root} of {provider} (BOOK_PROVIDER_ROOTS) is not in BOOK_ROOTS.")
+
+validate_storage()
+
+def root_hash(owner, provider, repo, roots):
+    """
+    Root of a repository among roots, for the hash sharding.
+    """
+    digest = hashlib.sha1(f"{provider}/{owner}/{repo}".encode()).hexdigest()
+    return roots[int(digest, 16) % len(roots)]
+
+def book_root_for(owner, provider, repo):
+    """
+    Storage root where the books of a repository are
+    placed (provider is the full name, e.g., github.com).
+    """
+    if len(BOOK_ROOTS) == 1:
+        return BOOK_ROOTS[0]
+    if BOOK_SHARDING == "provider" and provider in BOOK_PROVIDER_ROOTS:
+        return BOOK_PROVIDER_ROOTS[provider]
+    return root_hash(owner, provider, repo, BOOK_ROOTS)
+
+def preview_book_roots(owner, provider, repo):
+    """
+    Book roots of the preview server, in the order to look for the
+    books of a repository: the one it is placed on with the hash
+    sharding first, then the others (other sharding, or books placed
+    before a root was added).
+    """
+    first = root_hash(owner, provider, repo, PREVIEW_BOOK_ROOTS)
+    return [first] + [root for root in PREVIEW_BOOK_ROOTS if root != first]
+
+def book_repo_dir(owner, provider, repo):
+    """
+    Directory of the books of a repository. The one that
+    already exists on any of the roots if so, the one on the
+    root the repository is placed on otherwise.
+    """
+    for root in [book_root_for(owner, provider, repo)] + BOOK_ROOTS:
+        repo_dir = os.path.join(root, owner, provider, repo)
+        if os.path.isdir(repo_dir):
+            return repo_dir
+    return os.path.join(book_root_for(owner, provider, repo), owner, provider, repo)
+
+def book_dir(owner, provider, repo, commit_hash):
+    """
+    Directory of the book built for a repository at commit_hash.
+    """
+    return os.path.join(book_repo_dir(owner, provider, repo), commit_hash)
+
+def book_tarball(owner, provider, repo, commit_hash):
+    """
+    Archive of the book built for a repository at commit_hash.
+    """
+    return book_dir(owner, provider, repo, commit_hash) + ".tar.gz"
+
+def book_globs(pattern="*.tar.gz"):
+    """
+    Glob patterns matching book level entries on all the roots,
+    e.g. book tarballs (default) or the tarball of a commit.
+    """
+    return [f"{root}/*/*/*/{pattern}" for root in BOOK_ROOTS]
+
+def book_glob(pattern="*.tar.gz"):
+    """
+    Paths matching book_globs on all the roots.
+    """
+    paths = []
+    for globpath in book_globs(pattern):
+        paths.extend(glob.glob(globpath))
+    return paths
+
+def book_root_of(path):
+    """
+    Storage root that a path belongs to, None if it is not
+    under any of the book roots.
+    """
+    for root in BOOK_ROOTS:
+        if path == root or path.startswith(root + os.sep):
+            return root
+    return None
+
+def book_relpath(path):
+    """
+    Path relative to its storage root, e.g. for URLs.
+    """
+    root = book_root_of(path)
+    if root is None:
+        raise ValueError(f"{path} is not under any of the book roots.")
+    return os.path.relpath(path, root)
+
+def book_url(path):
+    """
+    Public URL of a path under one of the book roots.
+    """
+    return f"{BOOK_URL}/{book_relpath(path)}"
+
+def archive_dir(issue_id):
+    """
+    Directory of the Zenodo archives of a submission.
+    """
+    return os.path.join(DATA_ROOT, "zenodo", f"{issue_id:05d}")
+
+def deposit_dir(issue_id):
+    """
+    Directory of the Zenodo records of a submission.
+    """
+    return os.path.join(DATA_ROOT, "zenodo_records", f"{issue_id:05d}")
+
+def data_dir(project_name):
+    """
+    Directory of the data of a project (repo2data).
+    """
+    return os.path.join(DATA_ROOT, project_name)
+
+def doi_dir(issue_id=None):
+    """
+    Directory of the DOI formatted books (and summary PDFs),
+    or of a given submission.
+    """
+    if issue_id is None:
+        return os.path.join(DATA_ROOT, "10.55458")
+    return os.path.join(DATA_ROOT, "10.55458", f"neurolibre.{issue_id:05d}")
+
+def data_path(*parts):
+    """
+    Any other path under the data root (e.g., logs).
+    """
+    return os.path.join(DATA_ROOT, *parts)
+
+def binder_log_path(task_id):
+    """
+    BinderHub build log of a (book build) task.
+    """
+    return data_path("binder_logs", f"{task_id}.log")
+
+def binder_log_url(task_id):
+    """
+    Public URL of the BinderHub build log of a task.
+    """
+    return f"{BINDER_LOG_URL}/{task_id}.log"
@@ -0,0 +1,97 @@
+import os
+import time
+import random
+import logging
+import inspect
+import functools
+import redis
+"""
+Fairness between the submissions (issues) on the Celery queues:
+a task of an issue that already has ISSUE_SLOTS tasks running on
+the same queue is retried later instead of taking another worker,
+so that one submission (e.g., many data syncs or uploads) cannot
+monopolize the workers of a queue.
+
+Slots are kept in Redis (a sorted set per queue and issue, scored
+by expiry) and expire after ISSUE_SLOT_TTL, in case a worker dies
+without releasing them. Decorate the task functions with issue_fair
+(below the celery_app.task decorator).
+"""
+
+TASK_SLOTS_REDIS = os.getenv('TASK_SLOTS_REDIS', 'redis://localhost:6379/2')
+TASK_SLOTS_KEY = "neurolibre:task_slots"
+ISSUE_SLOTS = int(os.getenv('ISSUE_SLOTS', 1))
+ISSUE_SLOT_TTL = 12 * 3600
+# Seconds before a task waiting for a slot is tried again.
+ISSUE_SLOT_RETRY = 60
+
+redis_client = redis.Redis.from_url(TASK_SLOTS_REDIS, socket_timeout=1)
+
+# Drops the expired slots first, returns 1 if the task holds
+# (or now took) a slot.
+ACQUIRE_SCRIPT = redis_client.register_script("""
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", ARGV[2])
+if redis.call("ZSCORE", KEYS[1], ARGV[1]) then
+    return 1
+end
+if redis.call("ZCARD", KEYS[1]) < tonumber(ARGV[3]) then
+    redis.call("ZADD", KEYS[1], ARGV[2] + ARGV[4], ARGV[1])
+    redis.call("EXPIRE", KEYS[1], ARGV[4])
+    return 1
+end
+return 0
+""")
+
+def issue_slot_key(queue, issue_id):
+    return f"{TASK_SLOTS_KEY}:{queue}:{issue_id}"
+
+def issue_slot_acquire(queue, issue_id, task_id):
+    """
+    True if the task may run, i.e. it took one of the
+    slots of the issue on the queue.
+    """
+    try:
+        return ACQUIRE_SCRIPT(keys=[issue_slot_key(queue, issue_id)],
+                              args=[task_id, time.time(), ISSUE_SLOTS, ISSUE_SLOT_TTL]) == 1
+    except redis.RedisError as e:
+        logging.warning(f"Task slots are not available: {str(e)}")
+        return True
+
+def issue_slot_release(queue, issue_id, task_id):
+    try:
+        redis_client.zrem(issue_slot_key(queue, issue_id), task_id)
+    except redis.RedisError as e:
+        logging.warning(f"Task slot could not be released: {str(e)}")
+
+def task_issue_id(func, args, kwargs):
+    """
+    Issue id of a task call, passed either as the issue_id
+    argument or in the payload, None if there is none.
+    """
+    arguments = inspect.signature(func).bind_partial(*args, **kwargs).arguments
+    if arguments.get('issue_id') is not None:
+        return arguments['issue_id']
+    payload = arguments.get('payload')
+    if isinstance(payload, dict):
+        return payload.get('issue_id')
+    return None
+
+def issue_fair(func):
+    """
+    Run a (bound) task only if its issue has a free slot
+    on the queue of the task, retry it later otherwise.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        issue_id = task_issue_id(func, (self,) + args, kwargs)
+        if issue_id is None:
+            return func(self, *args, **kwargs)
+        queue = (self.request.delivery_info or {}).get('routing_key') or "celery"
+        if not issue_slot_acquire(queue, issue_id, self.request.id):
+            # Jitter, so that the waiting tasks of an issue do not all come back at once.
+            raise self.retry(countdown=ISSUE_SLOT_RETRY + random.randint(0, ISSUE_SLOT_RETRY), max_retries=None)
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            issue_slot_release(queue, issue_id, self.request.id)
+    return wrapper
@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, API_DIR)
+
+# The server modules read their configuration on import.
+DATA_DIR = tempfile.mkdtemp()
+os.environ.setdefault('NEUROLIBRE_DATA', DATA_DIR)
+os.environ.setdefault('BOOK_ROOTS', os.path.join(DATA_DIR, "book-artifacts"))
+if not os.getenv('AUTH_KEY'):
+    os.environ['AUTH_KEY'] = os.path.join(DATA_DIR, "htpasswd")
+    with open(os.environ['AUTH_KEY'], 'w') as f:
+        f.write("")
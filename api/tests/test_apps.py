@@ -0,0 +1,10 @@
+import importlib
+import pytest
+
+@pytest.mark.parametrize("module", ["neurolibre_preview_api", "neurolibre_preprint_api"])
+def test_app_imports(module):
+    app = importlib.import_module(module).app
+    # Each authenticated route of the common blueprint is its own endpoint.
+    for endpoint in ["api_unlock_build", "api_build_lock_status", "api_github_budget"]:
+        assert f"common_api.{endpoint}" in app.view_functions
+    assert "common_api.wrapper" not in app.view_functions
@@ -0,0 +1,17 @@
+from preprint import build_resource_table, parse_tsv_content
+
+OLD_COMMIT = "a" * 40
+NEW_COMMIT = "b" * 40
+LOOKUP_TABLE = "\n".join([
+    "date\trepository_url\tdocker_image\tproject_name\tdata_url\tdata_doi",
+    f"2023-01-01,https://github.com/roboneurolibre/repo,registry/binder-repo:{OLD_COMMIT},project,,",
+    f"2023-02-01,https://github.com/roboneurolibre/repo.git,registry/binder-repo:{NEW_COMMIT},project,,",
+])
+
+def test_build_resource_table_latest_row_wins():
+    table = build_resource_table(parse_tsv_content(LOOKUP_TABLE))
+    url = "https://github.com/roboneurolibre/repo"
+    assert table[url]["docker_image"].endswith(NEW_COMMIT)
+    # Builds at an older commit can still be looked up.
+    assert table[(url, OLD_COMMIT)]["docker_image"].endswith(OLD_COMMIT)
+    assert table[(url, NEW_COMMIT)]["docker_image"].endswith(NEW_COMMIT)
@@ -0,0 +1,27 @@
+import os
+import logging
+import flask
+from dotenv import load_dotenv
+from werkzeug.middleware.proxy_fix import ProxyFix
+import neurolibre_binder_api
+"""
+BinderHub build proxy of the production server on its own,
+to be run with gevent workers (gunicorn patches the standard
+library for them), see systemd/neurolibre-binder.service.
+"""
+
+load_dotenv()
+
+app = flask.Flask(__name__)
+
+app.config.from_pyfile('preprint_config.py')
+app.config['FLASK_HTPASSWD_PATH'] = os.getenv('AUTH_KEY')
+
+app.register_blueprint(neurolibre_binder_api.binder_api)
+
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
+
+gunicorn_error_logger = logging.getLogger('gunicorn.error')
+app.logger.handlers.extend(gunicorn_error_logger.handlers)
+app.logger.setLevel(logging.DEBUG)
+app.logger.debug('NeuroLibre BinderHub build proxy.')
@@ -0,0 +1,27 @@
+"""
+Live build events of the preview server on their own, to be
+run with gevent workers (gunicorn patches the standard library
+for them), see systemd/neurolibre-events.service.
+"""
+import os
+import logging
+import flask
+from dotenv import load_dotenv
+from werkzeug.middleware.proxy_fix import ProxyFix
+import neurolibre_events_api
+
+load_dotenv()
+
+app = flask.Flask(__name__)
+
+app.config.from_pyfile('preview_config.py')
+app.config['FLASK_HTPASSWD_PATH'] = os.getenv('AUTH_KEY')
+
+app.register_blueprint(neurolibre_events_api.events_api)
+
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
+
+gunicorn_error_logger = logging.getLogger('gunicorn.error')
+app.logger.handlers.extend(gunicorn_error_logger.handlers)
+app.logger.setLevel(logging.DEBUG)
+app.logger.debug('NeuroLibre live build events.')